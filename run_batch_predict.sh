@@ -0,0 +1,20 @@
+#!/bin/bash
+#SBATCH --job-name=batch_predict
+#SBATCH --output=batch_predict_%a.out
+#SBATCH --nodes=1
+#SBATCH --mem=32G
+#SBATCH --cpus-per-task=16
+#SBATCH --time=4:00:00
+#SBATCH --array=0-15
+
+# merge once all tasks are done: python src/batch_predict.py --out_root <out> --merge
+# rerun a failed shard: sbatch --array=<shard> run_batch_predict.sh
+srun python src/batch_predict.py \
+    --img_root /d/hpc/projects/FRI/zr13891/datasets/floods/pred/images \
+    --mask_root /d/hpc/projects/FRI/zr13891/datasets/floods/pred/masks \
+    --out_root /d/hpc/projects/FRI/zr13891/datasets/floods/pred/out \
+    --num_shards 16 \
+    --threads $SLURM_CPUS_PER_TASK \
+    --precision bf16 \
+    --min_river_coverage 0.01 \
+    --checkpoint_path /d/hpc/home/zr13891/dragonhack/dragonhack2024/Dragonhack/b4qpb2zy/checkpoints/last.ckpt
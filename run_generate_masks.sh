@@ -3,10 +3,12 @@
 #SBATCH --output=output.out
 #SBATCH --nodes=1
 #SBATCH --mem=32G
+#SBATCH --cpus-per-task=16
 #SBATCH --time=1-0
 
 
 srun python src/generate_masks.py \
     /d/hpc/projects/FRI/zr13891/datasets/floods/images \
     /d/hpc/projects/FRI/zr13891/datasets/floods/water_seg \
-    /d/hpc/projects/FRI/zr13891/datasets/floods/masks
\ No newline at end of file
+    /d/hpc/projects/FRI/zr13891/datasets/floods/masks \
+    --workers $SLURM_CPUS_PER_TASK
\ No newline at end of file
@@ -12,4 +12,6 @@ srun nvidia-smi
 srun python src/predict.py \
     --img_root /d/hpc/projects/FRI/zr13891/datasets/floods/pred/images \
     --mask_root /d/hpc/projects/FRI/zr13891/datasets/floods/pred/masks \
+    --out_root /d/hpc/projects/FRI/zr13891/datasets/floods/pred/out \
+    --stream \
     --checkpoint_path /d/hpc/home/zr13891/dragonhack/dragonhack2024/Dragonhack/b4qpb2zy/checkpoints/last.ckpt
\ No newline at end of file
@@ -0,0 +1,96 @@
+import multiprocessing as mp
+import queue
+import time
+from itertools import islice
+
+
+class AlertChannel:
+    """Bounded inter-process queue that hands obstacle alerts from the web process to the Discord process.
+    Alerts are sent in batches so a prediction run costs one queue message per `batch_size` alerts.
+    Publishing never blocks, batches that do not fit are dropped and counted. The counters live in
+    shared memory so both processes see the same metrics.
+
+    Must be created before the processes are started and passed to both of them.
+
+    Args:
+        maxsize (int): Maximum number of batches waiting in the queue
+        batch_size (int): Maximum number of alerts per batch
+    """
+
+    def __init__(self, maxsize=256, batch_size=32):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.queue = mp.Queue(maxsize)
+        self.published = mp.Value('q', 0)
+        self.dropped = mp.Value('q', 0)
+        self.delivered = mp.Value('q', 0)
+        self.latency_total = mp.Value('d', 0.0)
+
+    @staticmethod
+    def _add(counter, value):
+        with counter.get_lock():
+            counter.value += value
+
+    def publish(self, alerts):
+        """Enqueues alerts without blocking.
+
+        Args:
+            alerts (iterable): Picklable alert dicts
+
+        Returns:
+            int: Number of alerts dropped because the queue was full
+        """
+        dropped = 0
+        alerts = iter(alerts)
+        while batch := [dict(alert, enqueued=time.time()) for alert in islice(alerts, self.batch_size)]:
+            try:
+                self.queue.put_nowait(batch)
+            except queue.Full:
+                dropped += len(batch)
+            else:
+                self._add(self.published, len(batch))
+        if dropped:
+            self._add(self.dropped, dropped)
+            print(f'Alert queue full, dropped {dropped} alerts')
+        return dropped
+
+    def drain(self, max_alerts=128, timeout=1.0):
+        """Takes the waiting alerts, blocking until some arrive or the timeout passes.
+
+        Args:
+            max_alerts (int): Stop taking batches once this many alerts were taken
+            timeout (float): Seconds to wait for the first batch
+
+        Returns:
+            list: Alerts in the order they were published, each with its queue latency in
+                seconds under 'queue_latency'
+        """
+        try:
+            alerts = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return []
+        while len(alerts) < max_alerts:
+            try:
+                alerts.extend(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        now = time.time()
+        for alert in alerts:
+            alert['queue_latency'] = now - alert.pop('enqueued')
+        self._add(self.delivered, len(alerts))
+        self._add(self.latency_total, sum(alert['queue_latency'] for alert in alerts))
+        return alerts
+
+    def stats(self):
+        """Returns the queue depth and the delivery counters."""
+        delivered = self.delivered.value
+        return {
+            'queued_batches': self.queue.qsize(),
+            'max_batches': self.maxsize,
+            'batch_size': self.batch_size,
+            'published': self.published.value,
+            'dropped': self.dropped.value,
+            'delivered': delivered,
+            'mean_queue_latency_ms': self.latency_total.value / delivered * 1000 if delivered else None,
+        }
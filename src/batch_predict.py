@@ -0,0 +1,371 @@
+import json
+import multiprocessing as mp
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import rasterio
+from rasterio.warp import transform_bounds
+
+from inference import set_threads
+from predict import find_scenes, load_predictor, predict_scene
+
+
+def shard_scenes(scenes, num_shards):
+    """
+    Split scenes into shards of similar total image size.
+
+    The largest images are assigned first, each to the currently smallest shard,
+    so the split only depends on the image names and sizes and every task
+    computes the same shards.
+
+    Returns:
+        list of `num_shards` lists of scenes
+    """
+    shards = [[] for _ in range(num_shards)]
+    loads = [0] * num_shards
+    for scene in sorted(scenes, key=lambda scene: (-scene[0].stat().st_size, scene[0].name)):
+        i = loads.index(min(loads))
+        shards[i].append(scene)
+        loads[i] += scene[0].stat().st_size
+    return [sorted(shard) for shard in shards]
+
+
+def shard_path(shard_root, shard, suffix):
+    return shard_root / f"shard_{shard:04d}{suffix}"
+
+
+def write_manifest(shard_root, shards):
+    """
+    Record the shard count and the images of every shard, or check them against
+    the manifest of an earlier run.
+
+    Every array task computes the same shards, so concurrent writes are identical
+    and replaced atomically.
+
+    Returns:
+        str: error message if the shards differ from the recorded ones, otherwise None
+    """
+    manifest = {
+        "num_shards": len(shards),
+        "shards": [[img_path.name for img_path, _ in shard] for shard in shards],
+    }
+    recorded = read_manifest(shard_root)
+    if recorded is not None:
+        if recorded != manifest:
+            return (
+                f"shards differ from {shard_root / 'manifest.json'} ({recorded['num_shards']} shards), "
+                "use the same --num_shards and images or a new --out_root."
+            )
+        return None
+    tmp = shard_root / f"manifest.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, shard_root / "manifest.json")
+    return None
+
+
+def read_manifest(shard_root):
+    """
+    Read the shard count and assignment written by `write_manifest`.
+
+    Returns:
+        dict with `num_shards` and the image names per shard under `shards`, None if there is no manifest
+    """
+    path = shard_root / "manifest.json"
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def read_progress(path):
+    """
+    Read the scenes a shard already finished.
+
+    Returns:
+        dict of image name to scene stats
+    """
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return {entry["image"]: entry for entry in map(json.loads, f)}
+
+
+def run_shard(shard, scenes, out_root, checkpoint_path, options, threads=None):
+    """
+    Predict the scenes of one shard and write its completion marker.
+
+    Scenes finished by an earlier attempt of the shard are not predicted again,
+    so a failed shard can be rerun on its own.
+
+    Args:
+        shard (int): index of the shard
+        scenes (list): (image path, mask path) pairs of the shard
+        out_root (Path): output dir, shard bookkeeping goes into its `shards` subdir
+        checkpoint_path (Path): checkpoint or exported model
+        options (dict): prediction options, `precision`, `tile_size`, `batch_size`,
+            `calibration_tiles`, `gate_threshold`, `cog`, `min_river_coverage`,
+            `obstacle_threshold`, `min_obstacle_pixels`, `coarse_scale` and `coarse_threshold`
+        threads (int): intra-op threads of this shard
+
+    Returns:
+        dict: shard stats, also stored in the completion marker
+    """
+    set_threads(threads, 1 if threads else None)
+    shard_root = out_root / "shards"
+    progress_path = shard_path(shard_root, shard, ".progress.jsonl")
+    done = read_progress(progress_path)
+    todo = [scene for scene in scenes if scene[0].name not in done]
+
+    tile_size = (options["tile_size"], options["tile_size"])
+    start = time.perf_counter()
+    if todo:
+        model = load_predictor(
+            checkpoint_path, options["precision"], todo[0], tile_size, options["calibration_tiles"],
+            options["gate_threshold"]
+        )
+        with open(progress_path, "a") as progress:
+            for img_path, mask_path in todo:
+                print(f"[shard {shard}] predicting {img_path}...")
+                out_path = out_root / f"{img_path.stem}.tif"
+                stats = predict_scene(
+                    model, img_path, mask_path, out_path, tile_size, options["batch_size"], options["cog"],
+                    options["min_river_coverage"], options["obstacle_threshold"], options["min_obstacle_pixels"],
+                    options["coarse_scale"], options["coarse_threshold"]
+                )
+                entry = {"image": img_path.name, "output": out_path.name, **stats}
+                progress.write(json.dumps(entry) + "\n")
+                progress.flush()
+                done[img_path.name] = entry
+
+    summary = {
+        "shard": shard,
+        "scenes": [done[img_path.name] for img_path, _ in scenes],
+        "seconds": time.perf_counter() - start,
+        "threads": threads,
+    }
+    marker = shard_path(shard_root, shard, ".done")
+    tmp = marker.with_suffix(".tmp")
+    with open(tmp, "w") as f:
+        json.dump(summary, f, indent=2)
+    os.replace(tmp, marker)
+    return summary
+
+
+def run_local(shards, out_root, checkpoint_path, options, workers, threads):
+    """
+    Run shards in local worker processes, shards that are already done are skipped.
+
+    Returns:
+        list of indices of the failed shards
+    """
+    pending = [
+        i for i in range(len(shards))
+        if not shard_path(out_root / "shards", i, ".done").exists()
+    ]
+    print(f"{len(shards) - len(pending)} shards already done, running {len(pending)}.")
+    failed = []
+    # spawn, torch thread pools do not survive a fork
+    with ProcessPoolExecutor(workers, mp_context=mp.get_context("spawn")) as executor:
+        futures = {
+            executor.submit(run_shard, i, shards[i], out_root, checkpoint_path, options, threads): i
+            for i in pending
+        }
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                summary = future.result()
+            except Exception as e:
+                print(f"shard {i} failed: {e}")
+                failed.append(i)
+            else:
+                print(f"shard {i} done in {summary['seconds']:.1f}s.")
+    return sorted(failed)
+
+
+def merge(out_root, num_shards):
+    """
+    Combine the shard results into a mosaic index and one obstacle list.
+
+    Writes `index.geojson` with the footprint of every output raster in EPSG:4326
+    and `obstacles.jsonl` with the obstacles of all scenes.
+
+    Returns:
+        list of indices of the shards without a completion marker, nothing is written if any
+    """
+    shard_root = out_root / "shards"
+    missing = [i for i in range(num_shards) if not shard_path(shard_root, i, ".done").exists()]
+    if missing:
+        return missing
+
+    features, totals = [], {"total": 0, "skipped": 0, "obstacles": 0}
+    with open(out_root / "obstacles.jsonl", "w") as obstacles:
+        for i in range(num_shards):
+            with open(shard_path(shard_root, i, ".done")) as f:
+                summary = json.load(f)
+            for scene in summary["scenes"]:
+                out_path = out_root / scene["output"]
+                with rasterio.open(out_path) as src:
+                    west, south, east, north = transform_bounds(src.crs, "EPSG:4326", *src.bounds)
+                features.append({
+                    "type": "Feature",
+                    "geometry": {
+                        "type": "Polygon",
+                        "coordinates": [[[west, south], [east, south], [east, north], [west, north], [west, south]]],
+                    },
+                    "properties": {**scene, "shard": i},
+                })
+                for key in totals:
+                    totals[key] += scene[key]
+
+                obstacles_path = out_path.with_suffix(".obstacles.jsonl")
+                if obstacles_path.exists():
+                    with open(obstacles_path) as f:
+                        for record in map(json.loads, f):
+                            obstacles.write(json.dumps({**record, "image": scene["image"]}) + "\n")
+
+    with open(out_root / "index.geojson", "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+    with open(out_root / "summary.json", "w") as f:
+        json.dump({"scenes": len(features), "shards": num_shards, **totals}, f, indent=2)
+    return []
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("Batch prediction")
+    parser.add_argument(
+        "--img_root", type=Path, help="Path to dir containing images."
+    )
+    parser.add_argument(
+        "--mask_root", type=Path, help="Path to dir containing masks."
+    )
+    parser.add_argument(
+        "--checkpoint_path", type=Path, help="Path to checkpoint or exported model."
+    )
+    parser.add_argument(
+        "--out_root", type=Path, default=Path("out"),
+        help="Path to output dir."
+    )
+    parser.add_argument(
+        "--num_shards", type=int, default=None,
+        help="Number of shards, defaults to $SLURM_ARRAY_TASK_COUNT or the number of workers, "
+        "--merge reads it from the shard manifest."
+    )
+    parser.add_argument(
+        "--shard", type=int, default=None,
+        help="Run only this shard, defaults to $SLURM_ARRAY_TASK_ID in an array job."
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="Local worker processes when running all shards."
+    )
+    parser.add_argument(
+        "--threads", type=int, default=None,
+        help="Intra-op threads per worker, defaults to the available CPUs split between the workers."
+    )
+    parser.add_argument(
+        "--merge", action="store_true",
+        help="Only merge the shard results."
+    )
+    parser.add_argument(
+        "--tile_size", type=int, default=256,
+        help="Tile size."
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=16,
+        help="Tiles per forward pass."
+    )
+    parser.add_argument(
+        "--min_river_coverage", type=float, default=0.0,
+        help="Tiles with river coverage at or below this ratio are skipped."
+    )
+    parser.add_argument(
+        "--obstacle_threshold", type=float, default=0.5,
+        help="Extract obstacles above this debris probability."
+    )
+    parser.add_argument(
+        "--min_obstacle_pixels", type=int, default=16,
+        help="Obstacles with fewer pixels are discarded."
+    )
+    parser.add_argument(
+        "--precision", choices=["fp32", "bf16", "int8"], default=None,
+        help="Run CPU optimized inference in this precision."
+    )
+    parser.add_argument(
+        "--calibration_tiles", type=int, default=64,
+        help="River tiles of the first image of a shard used to calibrate int8 quantization."
+    )
+    parser.add_argument(
+        "--coarse_scale", type=int, default=None,
+        help="Predict the scene downsampled by this factor first and refine only likely debris."
+    )
+    parser.add_argument(
+        "--coarse_threshold", type=float, default=0.2,
+        help="Coarse debris probability from which a window is refined at full resolution."
+    )
+    parser.add_argument(
+        "--gate_threshold", type=float, default=None,
+        help="Only decode tiles the tile classifier flags with at least this debris probability."
+    )
+    parser.add_argument(
+        "--cog", action="store_true",
+        help="Write cloud optimized GeoTIFFs."
+    )
+    args = parser.parse_args()
+    if args.coarse_scale is not None and args.coarse_scale < 1:
+        parser.error("--coarse_scale must be at least 1")
+
+    if args.shard is None and "SLURM_ARRAY_TASK_ID" in os.environ:
+        args.shard = int(os.environ["SLURM_ARRAY_TASK_ID"])
+
+    shard_root = args.out_root / "shards"
+    if args.merge:
+        # the shard count of the run, not of this invocation
+        manifest = read_manifest(shard_root)
+        if manifest is None:
+            sys.exit(f"no shard manifest in {shard_root}, run the shards first.")
+        if args.num_shards is not None and args.num_shards != manifest["num_shards"]:
+            sys.exit(f"--num_shards {args.num_shards} does not match the {manifest['num_shards']} shards of the run.")
+        missing = merge(args.out_root, manifest["num_shards"])
+        if missing:
+            sys.exit(f"shards {missing} are not done, rerun them with --shard.")
+        sys.exit()
+
+    if args.num_shards is None:
+        args.num_shards = int(os.environ.get("SLURM_ARRAY_TASK_COUNT", args.workers))
+    shard_root.mkdir(parents=True, exist_ok=True)
+    shards = shard_scenes(find_scenes(args.img_root, args.mask_root), args.num_shards)
+    error = write_manifest(shard_root, shards)
+    if error:
+        sys.exit(error)
+    options = {
+        "precision": args.precision,
+        "tile_size": args.tile_size,
+        "batch_size": args.batch_size,
+        "calibration_tiles": args.calibration_tiles,
+        "gate_threshold": args.gate_threshold,
+        "coarse_scale": args.coarse_scale,
+        "coarse_threshold": args.coarse_threshold,
+        "cog": args.cog,
+        "min_river_coverage": args.min_river_coverage,
+        "obstacle_threshold": args.obstacle_threshold,
+        "min_obstacle_pixels": args.min_obstacle_pixels,
+    }
+
+    # one thread pool per worker, oversubscribing the cores slows every worker down
+    cpus = len(os.sched_getaffinity(0))
+    if args.shard is not None:
+        threads = args.threads or cpus
+        run_shard(args.shard, shards[args.shard], args.out_root, args.checkpoint_path, options, threads)
+    else:
+        workers = min(args.workers, args.num_shards)
+        threads = args.threads or max(cpus // workers, 1)
+        failed = run_local(shards, args.out_root, args.checkpoint_path, options, workers, threads)
+        if failed:
+            sys.exit(f"shards {failed} failed, rerun them with --shard or rerun all to retry them.")
+        merge(args.out_root, args.num_shards)
+        print(f"merged {args.num_shards} shards into {args.out_root / 'index.geojson'}.")
@@ -0,0 +1,215 @@
+import json
+import platform
+import resource
+import statistics
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+import rasterio
+import torch
+from PIL import Image
+from rasterio.transform import from_origin
+
+from data.dataset import RiverDebrisDataset
+from data.scuffed_mixup import ScuffedMix
+from data.tiler import Tiler
+from models import RiverDebrisModel
+from predict import predict_scene
+
+
+def rss_mb(field="VmRSS"):
+    """Current (VmRSS) or peak (VmHWM) resident set size of the process in MB, None without procfs."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS of the process to its current RSS, so the next peak belongs to one benchmark.
+
+    Returns:
+        bool, False if the kernel does not support it and peaks cover the whole process
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """Peak resident set size since the last `reset_peak_rss` in MB, or of the whole process without procfs."""
+    peak = rss_mb("VmHWM")
+    return peak if peak is not None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(fn, repeats, warmup=1):
+    """
+    Time a function and track its peak memory.
+
+    Returns:
+        dict with median and mean seconds per call, the RSS before the benchmark and the peak RSS
+        during it, `peak_rss_per_benchmark` is False if the peak covers the whole process so far
+    """
+    rss_before = rss_mb()
+    per_benchmark = reset_peak_rss()
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {
+        "median_s": statistics.median(times),
+        "mean_s": statistics.mean(times),
+        "repeats": repeats,
+        "rss_before_mb": rss_before,
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_rss_per_benchmark": per_benchmark,
+    }
+
+
+def write_synthetic_scene(root, name, size, seed=0):
+    """
+    Write a random georeferenced RGB GeoTIFF and a river mask with a diagonal river.
+
+    Returns:
+        tuple of image and mask paths
+    """
+    rng = np.random.default_rng(seed)
+    h, w = size
+    img_path, mask_path = root / "images" / f"{name}.tif", root / "masks" / f"{name}.png"
+    img_path.parent.mkdir(exist_ok=True)
+    mask_path.parent.mkdir(exist_ok=True)
+
+    with rasterio.open(
+        img_path, "w", driver="GTiff", height=h, width=w, count=3, dtype="uint8",
+        crs="EPSG:3794", transform=from_origin(500000, 100000, 0.5, 0.5),
+        tiled=True, blockxsize=256, blockysize=256
+    ) as dst:
+        dst.write(rng.integers(0, 256, (3, h, w), dtype=np.uint8))
+
+    # river is a band around the diagonal, black like the generated masks
+    rows, cols = np.mgrid[:h, :w]
+    river = np.abs(rows / h - cols / w) < 0.1
+    Image.fromarray(np.where(river, 0, 255).astype(np.uint8)).save(mask_path)
+    return img_path, mask_path
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("Benchmark")
+    parser.add_argument(
+        "--out_path", type=Path, default=Path("benchmark.json"),
+        help="Path of the JSON results."
+    )
+    parser.add_argument(
+        "--repeats", type=int, default=5,
+        help="Timed repetitions per benchmark."
+    )
+    parser.add_argument(
+        "--scene_size", type=int, default=4096,
+        help="Size of the synthetic scene used end to end."
+    )
+    parser.add_argument(
+        "--batch_sizes", type=int, nargs="+", default=[1, 4, 16],
+        help="UNet forward batch sizes."
+    )
+    parser.add_argument(
+        "--tile_sizes", type=int, nargs="+", default=[128, 256],
+        help="UNet forward tile sizes."
+    )
+    parser.add_argument(
+        "--seed", type=int, default=1337,
+        help="RNG seed."
+    )
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    results = {
+        "meta": {
+            "torch": torch.__version__,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "threads": torch.get_num_threads(),
+            "seed": args.seed,
+        },
+        "benchmarks": {},
+    }
+    benchmarks = results["benchmarks"]
+
+    def record(name, result, **extra):
+        result.update(extra)
+        benchmarks[name] = result
+        print(name, json.dumps(result))
+
+    # tiler
+    img = torch.rand(3, 2048, 2048)
+    for name, tiler in [
+        ("tiler_2048_256", Tiler((2048, 2048), (256, 256))),
+        ("tiler_2048_256_overlap", Tiler((2048, 2048), (256, 256), (192, 192))),
+    ]:
+        tiles = tiler.tile(img)
+        record(f"{name}.tile", measure(lambda: tiler.tile(img), args.repeats), tiles=len(tiles))
+        record(f"{name}.untile", measure(lambda: tiler.untile(tiles), args.repeats), tiles=len(tiles))
+
+    # augmentation on the tiles of one image
+    tiler = Tiler((2048, 2048), (256, 256))
+    img_tiles = tiler.tile(img)
+    rows, cols = torch.meshgrid(torch.arange(2048), torch.arange(2048), indexing="ij")
+    river_mask_tiles = tiler.tile(((rows / 2048 - cols / 2048).abs() < 0.1).float()[None])
+    mix = ScuffedMix()
+    record("scuffed_mix", measure(lambda: mix(img_tiles, river_mask_tiles), args.repeats), tiles=len(img_tiles))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+
+        # data loading of a full training sample
+        for i in range(2):
+            write_synthetic_scene(root, f"train_{i}", (2048, 2048), seed=i)
+        dataset = RiverDebrisDataset(root / "images", root / "masks", (2048, 2048), (256, 256))
+        record("dataset.getitem", measure(lambda: dataset[0], args.repeats))
+
+        # UNet forward at several batch and tile sizes, random weights
+        model = RiverDebrisModel(lr=1e-4).eval()
+        with torch.inference_mode():
+            model.model(torch.rand(1, 3, 256, 256))
+            for tile_size in args.tile_sizes:
+                for batch_size in args.batch_sizes:
+                    x = torch.rand(batch_size, 3, tile_size, tile_size)
+                    result = measure(lambda: model.model(x), args.repeats)
+                    record(
+                        f"unet_forward.t{tile_size}.b{batch_size}", result,
+                        tiles_per_s=batch_size / result["median_s"]
+                    )
+
+        # end-to-end streaming prediction of a synthetic scene
+        img_path, mask_path = write_synthetic_scene(root, "scene", (args.scene_size, args.scene_size))
+        out_path = root / "scene_pred.tif"
+        stats = {}
+
+        def predict():
+            stats.update(predict_scene(model, img_path, mask_path, out_path))
+
+        result = measure(predict, max(args.repeats // 2, 1))
+        predicted = stats["total"] - stats["skipped"]
+        record(
+            "predict_scene", result, **stats,
+            tiles_per_s=stats["total"] / result["median_s"],
+            predicted_tiles_per_s=predicted / result["median_s"],
+            mb_per_s=img_path.stat().st_size / 2 ** 20 / result["median_s"]
+        )
+
+    # the resets also lower the process peak, so it is the largest peak of any benchmark
+    results["meta"]["peak_rss_mb"] = max([peak_rss_mb()] + [result["peak_rss_mb"] for result in benchmarks.values()])
+    with open(args.out_path, "w") as f:
+        json.dump(results, f, indent=2)
@@ -0,0 +1,116 @@
+import json
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import torch
+
+from data.dataset import RiverDebrisPredDataset
+from inference import CPUModel, load_model, set_threads
+from predict import batched
+
+
+def run(model, batches):
+    """
+    Predict all batches.
+
+    Returns:
+        tuple of predictions [N, 1, H, W] and seconds per tile
+    """
+    # warm up so one-time allocations and kernel selection are not timed
+    model.predict_tiles(*batches[0])
+    start = time.perf_counter()
+    preds = torch.cat([model.predict_tiles(x, river_mask) for x, river_mask in batches])
+    return preds, (time.perf_counter() - start) / len(preds)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("CPU inference report")
+    parser.add_argument(
+        "--img_root", type=Path, help="Path to dir containing held-out images."
+    )
+    parser.add_argument(
+        "--mask_root", type=Path, help="Path to dir containing masks."
+    )
+    parser.add_argument(
+        "--checkpoint_path", type=Path, help="Path to checkpoint."
+    )
+    parser.add_argument(
+        "--modes", nargs="+", default=["fp32", "bf16", "int8"],
+        help="Precisions to compare against the fp32 model."
+    )
+    parser.add_argument(
+        "--num_tiles", type=int, default=256,
+        help="Number of river tiles to evaluate on."
+    )
+    parser.add_argument(
+        "--calibration_tiles", type=int, default=64,
+        help="Number of river tiles used to calibrate int8, not evaluated on."
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=16,
+        help="Tiles per forward pass."
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=0.5,
+        help="Debris probability threshold for the IoU against fp32."
+    )
+    parser.add_argument(
+        "--intra_op_threads", type=int, default=None,
+        help="Threads used inside an operator."
+    )
+    parser.add_argument(
+        "--inter_op_threads", type=int, default=None,
+        help="Threads used to run independent operators."
+    )
+    parser.add_argument(
+        "--out_path", type=Path, default=Path("cpu_report.json"),
+        help="Path of the JSON report."
+    )
+    args = parser.parse_args()
+
+    set_threads(args.intra_op_threads, args.inter_op_threads)
+    model = load_model(args.checkpoint_path)
+
+    # river tiles of the held-out images
+    dataset = RiverDebrisPredDataset(args.img_root, args.mask_root, (2048, 2048), (256, 256))
+    needed = args.calibration_tiles + args.num_tiles
+    images, masks = [], []
+    for img_tiles, river_mask_tiles in dataset:
+        keep = river_mask_tiles.flatten(1).any(dim=1)
+        images.extend(img_tiles[keep])
+        masks.extend(river_mask_tiles[keep])
+        if len(images) >= needed:
+            break
+
+    calibration = [torch.stack(x) for x in batched(images[:args.calibration_tiles], args.batch_size)]
+    batches = [
+        (torch.stack(x), torch.stack(m)) for x, m in zip(
+            batched(images[args.calibration_tiles:needed], args.batch_size),
+            batched(masks[args.calibration_tiles:needed], args.batch_size)
+        )
+    ]
+    print(f"evaluating on {sum(len(x) for x, _ in batches)} tiles...")
+
+    # plain fp32 model as the reference
+    reference, reference_time = run(CPUModel(model, "fp32", channels_last=False), batches)
+    ref_mask = reference >= args.threshold
+
+    report = {"threads": torch.get_num_threads(), "reference_ms_per_tile": reference_time * 1000, "modes": {}}
+    for mode in args.modes:
+        cpu_model = CPUModel(model, mode, calibration=calibration)
+        preds, tile_time = run(cpu_model, batches)
+        pred_mask = preds >= args.threshold
+        union = (pred_mask | ref_mask).sum()
+        report["modes"][mode] = {
+            "ms_per_tile": tile_time * 1000,
+            "tiles_per_sec": 1 / tile_time,
+            "speedup": reference_time / tile_time,
+            "mean_abs_error": float((preds - reference).abs().mean()),
+            "max_abs_error": float((preds - reference).abs().max()),
+            "iou_vs_fp32": float((pred_mask & ref_mask).sum() / union) if union else 1.0,
+        }
+        print(mode, json.dumps(report["modes"][mode]))
+
+    with open(args.out_path, "w") as f:
+        json.dump(report, f, indent=2)
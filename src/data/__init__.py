@@ -1 +1,6 @@
-from .datamodule import RiverDebrisDataModule
\ No newline at end of file
+def __getattr__(name):
+    # imported on first use so the prediction modules under data/ load without Lightning
+    if name == "RiverDebrisDataModule":
+        from .datamodule import RiverDebrisDataModule
+        return RiverDebrisDataModule
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -2,17 +2,43 @@ from torch.utils.data import DataLoader
 import lightning as L
 
 from .dataset import RiverDebrisDataset
+from .tile_cache import CachedRiverDebrisDataset, RiverDebrisTileDataset
 
 
 class RiverDebrisDataModule(L.LightningDataModule):
+    """
+    Args:
+        cache_root (Path): (optional) tile cache to read instead of the images, see preprocess.py
+        tile_batch_size (int): (optional) sample single river tiles from the tile cache
+            in batches of this size instead of all tiles of one image
+        num_workers (int): data loader workers
+    """
 
-    def __init__(self, img_root, mask_root, img_size, patch_size):
+    def __init__(self, img_root, mask_root, img_size, patch_size, cache_root=None,
+                 tile_batch_size=None, num_workers=4):
         super().__init__()
-        self.train_dataset = RiverDebrisDataset(
-            img_root, mask_root, img_size, patch_size
-        )
+        self.tile_batch_size = tile_batch_size
+        self.num_workers = num_workers
+        if tile_batch_size is not None:
+            assert cache_root is not None, "Tile sampling needs a tile cache"
+            self.train_dataset = RiverDebrisTileDataset(cache_root)
+        elif cache_root is not None:
+            # preprocessed tiles, see preprocess.py
+            self.train_dataset = CachedRiverDebrisDataset(cache_root)
+        else:
+            self.train_dataset = RiverDebrisDataset(
+                img_root, mask_root, img_size, patch_size
+            )
     
     def train_dataloader(self):
+        if self.tile_batch_size is None:
+            return DataLoader(
+                self.train_dataset, 1, shuffle=True, num_workers=self.num_workers
+            )
+        # constant [B, C, H, W] batches shuffled across images
         return DataLoader(
-            self.train_dataset, 1, shuffle=True, num_workers=4
+            self.train_dataset, self.tile_batch_size, shuffle=True, drop_last=True,
+            num_workers=self.num_workers, pin_memory=True,
+            persistent_workers=self.num_workers > 0,
+            prefetch_factor=4 if self.num_workers > 0 else None
         )
\ No newline at end of file
@@ -43,21 +43,44 @@ class RiverDebrisDataset(Dataset):
 
         # generate tiles - [B, C, H, W], [B, 1, H, W]
         img_tiles, river_mask_tiles = self.tiler.tile(image), self.tiler.tile(river_mask)
+        return self.augment(img_tiles, river_mask_tiles)
 
+    def augment(self, img_tiles, river_mask_tiles, river_only=True):
+        """
+        Paste synthetic debris into the river and build the debris targets.
+
+        Args:
+            img_tiles (torch.Tensor): float image tiles of shape [B, C, H, W]
+            river_mask_tiles (torch.Tensor): float river mask tiles of shape [B, 1, H, W]
+            river_only (bool): drop the tiles that contain no river
+
+        Returns:
+            mixed image tiles, debris mask tiles and tile labels [B], 1 for tiles with debris
+        """
         # cut mix babey, find mask where mix and normal images are different
         mix_img_tiles = self.mix(img_tiles, river_mask_tiles)
         mix_mask_tiles = (mix_img_tiles != img_tiles)[:, [0]]
 
         # mask the image so only river shows and merge mix_mask and river mask
         debris_mask_tiles = (river_mask_tiles - mix_mask_tiles.float()).clamp(0, 1)
+
+        # cls labels are 0 if no debris in patch, else 1
+        cls_labels = (river_mask_tiles * mix_mask_tiles).flatten(1).any(dim=1).float()
     
-        # cls labels are 0 if no debris mask in patch, else 1
+        if not river_only:
+            return mix_img_tiles, debris_mask_tiles, cls_labels
+
         contains_river = debris_mask_tiles.reshape((debris_mask_tiles.shape[0], -1)).any(dim=1)
-        return mix_img_tiles[contains_river], debris_mask_tiles[contains_river]
+        return mix_img_tiles[contains_river], debris_mask_tiles[contains_river], cls_labels[contains_river]
 
 
 class RiverDebrisPredDataset(RiverDebrisDataset):
 
+    def __init__(self, img_root, mask_root, img_size, patch_size, stride=None):
+        super().__init__(img_root, mask_root, img_size, patch_size)
+        # overlapping tiles are blended in untile to remove seams
+        self.tiler = Tiler(img_size, patch_size, stride)
+
     def __getitem__(self, index):
         # load image and river mask
         image = tv_tensors.Image(
@@ -0,0 +1,140 @@
+import math
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+
+class RasterTileReader:
+    """
+    Reads an image and its river mask window by window at native resolution.
+
+    Args:
+        img_path (Path): path to the (geo)tiff image
+        mask_path (Path): path to the river mask, pixels equal to 0 are river.
+            If the mask has a different size than the image it is resampled per window.
+        tile_size (tuple[int, int]): tile size
+    """
+
+    def __init__(self, img_path, mask_path, tile_size: tuple[int, int]):
+        self.img = rasterio.open(img_path)
+        self.mask = rasterio.open(mask_path) if mask_path is not None else None
+        self.tile_size = tile_size
+
+        # scale from image pixels to mask pixels
+        if self.mask is not None:
+            self.mask_scale = (self.mask.height / self.img.height, self.mask.width / self.img.width)
+
+        # integer images are scaled into [0, 1] the same way as v2.ToDtype(scale=True)
+        dtype = np.dtype(self.img.dtypes[0])
+        self.scale = np.iinfo(dtype).max if np.issubdtype(dtype, np.integer) else 1
+
+    @property
+    def shape(self):
+        return self.img.height, self.img.width
+
+    def windows(self):
+        """
+        Iterate over tile windows in row-major order, edge windows extend past the image.
+
+        Yields:
+            rasterio.windows.Window of size tile_size
+        """
+        t_h, t_w = self.tile_size
+        for row in range(0, self.img.height, t_h):
+            for col in range(0, self.img.width, t_w):
+                yield Window(col, row, t_w, t_h)
+
+    def read_image(self, window: Window):
+        """
+        Read an image tile, areas outside the image are zero padded.
+
+        Returns:
+            float32 array of shape [C, t_h, t_w] in [0, 1]
+        """
+        tile = self.img.read(window=window, boundless=True, fill_value=0)
+        return tile.astype(np.float32) / self.scale
+
+    def read_mask(self, window: Window):
+        """
+        Read a river mask tile, areas outside the image are not river.
+
+        Returns:
+            float32 array of shape [1, t_h, t_w], 1 where river
+        """
+        if self.mask is None:
+            return np.ones((1, *self.tile_size), dtype=np.float32)
+
+        s_h, s_w = self.mask_scale
+        mask_window = Window(
+            window.col_off * s_w, window.row_off * s_h,
+            window.width * s_w, window.height * s_h
+        )
+        tile = self.mask.read(
+            1, window=mask_window, out_shape=self.tile_size,
+            boundless=True, fill_value=255
+        )
+        return (tile == 0).astype(np.float32)[None]
+
+    def read_overview(self, window: Window, scale: int):
+        """
+        Read an image window and its river mask downsampled by `scale`. The image is
+        area averaged and can be served from the overviews of the file, areas outside
+        the image are zero and not river.
+
+        Returns:
+            float32 arrays of shape [C, h, w] in [0, 1] and [1, h, w], 1 where river
+        """
+        out_shape = (math.ceil(window.height / scale), math.ceil(window.width / scale))
+        image = self.img.read(
+            window=window, out_shape=(self.img.count, *out_shape),
+            resampling=Resampling.average, boundless=True, fill_value=0
+        )
+        image = image.astype(np.float32) / self.scale
+        if self.mask is None:
+            return image, np.ones((1, *out_shape), dtype=np.float32)
+
+        s_h, s_w = self.mask_scale
+        mask_window = Window(
+            window.col_off * s_w, window.row_off * s_h,
+            window.width * s_w, window.height * s_h
+        )
+        mask = self.mask.read(
+            1, window=mask_window, out_shape=out_shape,
+            resampling=Resampling.nearest, boundless=True, fill_value=255
+        )
+        return image, (mask == 0).astype(np.float32)[None]
+
+    def output_profile(self, **kwargs):
+        """
+        Profile for a single band georeferenced output aligned with the image.
+        """
+        t_h, t_w = self.tile_size
+        profile = {
+            "driver": "GTiff",
+            "height": self.img.height,
+            "width": self.img.width,
+            "count": 1,
+            "dtype": "float32",
+            "crs": self.img.crs,
+            "transform": self.img.transform,
+            "tiled": True,
+            "blockxsize": t_w,
+            "blockysize": t_h,
+            "compress": "deflate",
+            "BIGTIFF": "IF_SAFER",
+        }
+        profile.update(kwargs)
+        return profile
+
+    def close(self):
+        self.img.close()
+        if self.mask is not None:
+            self.mask.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
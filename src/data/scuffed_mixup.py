@@ -5,76 +5,86 @@ class ScuffedMix(nn.Module):
 
     def forward(self, img_batch, mask_batch):
         """
+        Generate synth anomalies in the river of every tile at once
+        (makeshift better version of cutmix (task specific pro mlg turbo version))
+
+        A rectangle from outside the river is pasted onto a rectangle of the same
+        size inside the river. Tiles with too little river or land are left as is.
+
         Args:
-            x: batched img: [B, N, H, W]
+            img_batch: batched img: [B, C, H, W]
+            mask_batch: batched segmentation mask: [B, 1, H, W]
+
+        Returns:
+            images with generated anomalies: [B, C, H, W]
         """
-        imgs = []
-        for img, mask in zip(img_batch, mask_batch):
-            els = mask.sum()
-            if els > 1000 and els < mask.numel() - 1000:
-                img = synth_gen(img, mask)
-            imgs.append(img)
-        return torch.stack(imgs)
+        b, _, h, w = img_batch.shape
+        mask = mask_batch[:, 0] > 0
+        els = mask.flatten(1).sum(dim=1)
+        ok = (els > 1000) & (els < h * w - 1000)
 
-def synth_gen(img, mask):
-    """
-    Generate synth anomalies in river
-    (makeshift better version of cutmix (task specific pro mlg turbo version))
+        # randomly generate rectangle half sizes
+        r_h_half = torch.randint(int(h * 0.02), int(h * 0.05), size=(b,), device=img_batch.device)
+        r_w_half = torch.randint(int(w * 0.02), int(w * 0.05), size=(b,), device=img_batch.device)
 
-    Args:
-        img: input image
-        mask: segmentation mask
+        # centers whose rectangle fits into the tile
+        fits = valid_centers(h, w, r_h_half, r_w_half)
+        # destination of anomaly in river, source outside the river
+        dst_y, dst_x, dst_ok = sample_centers(mask & fits)
+        src_y, src_x, src_ok = sample_centers(~mask & fits)
+        ok &= dst_ok & src_ok
 
-    Returns:
-        image with generated anomalies
-    """
-    img = img.clone()
-    # generate coords for destination of anomaly in river
-    dx1, dy1, dx2, dy2, r_w_half, r_h_half = get_coords(mask)
-    # generate coords with same shape for source of anomaly outisde the river
-    sx1, sy1, sx2, sy2, _, _ = get_coords((mask == 0), r_w_half, r_h_half)
-    img[..., dy1:dy2, dx1:dx2] = img[..., sy1:sy2, sx1:sx2]
+        # offsets inside the largest rectangle, masked per tile to its own size
+        dy = torch.arange(2 * int(r_h_half.max()), device=img_batch.device)
+        dx = torch.arange(2 * int(r_w_half.max()), device=img_batch.device)
+        inside = (
+            (dy[None, :, None] < 2 * r_h_half[:, None, None])
+            & (dx[None, None, :] < 2 * r_w_half[:, None, None])
+            & ok[:, None, None]
+        )
+        batch_idx = torch.arange(b, device=img_batch.device)[:, None, None].expand_as(inside)[inside]
+        dst_rows = (dst_y - r_h_half)[:, None, None] + dy[None, :, None]
+        dst_cols = (dst_x - r_w_half)[:, None, None] + dx[None, None, :]
+        src_rows = (src_y - r_h_half)[:, None, None] + dy[None, :, None]
+        src_cols = (src_x - r_w_half)[:, None, None] + dx[None, None, :]
 
-    return img
+        imgs = img_batch.clone()
+        imgs[batch_idx, :, dst_rows.expand_as(inside)[inside], dst_cols.expand_as(inside)[inside]] = \
+            img_batch[batch_idx, :, src_rows.expand_as(inside)[inside], src_cols.expand_as(inside)[inside]]
+        return imgs
 
-def get_coords(mask, r_w_half=None, r_h_half=None):
+def valid_centers(h, w, r_h_half, r_w_half):
     """
-    Get coordinates within the segmentation mask (where mask == 1)
+    Get the centers whose rectangle lies completely inside the image
 
     Args:
-        mask: segmentation mask where regions of interest are set to 1
-        r_w_half: (optional) half of width
-        r_h_half: (optional) half of height
+        h: image height
+        w: image width
+        r_h_half: [B] half of height
+        r_w_half: [B] half of width
 
     Returns:
-        coordinates and size
+        [B, H, W] mask of valid centers
     """
-    _, h, w = mask.shape
-    # get nonzero indices from mask (we only want to pick cutout from these)
-    nonzero = torch.nonzero(mask)
+    ys = torch.arange(h, device=r_h_half.device)[None, :, None]
+    xs = torch.arange(w, device=r_w_half.device)[None, None, :]
+    r_h_half, r_w_half = r_h_half[:, None, None], r_w_half[:, None, None]
+    return (ys >= r_h_half) & (ys + r_h_half <= h) & (xs >= r_w_half) & (xs + r_w_half <= w)
 
-    cut_ok = False
-
-    # loop to make sure the size is okay
-    while not cut_ok:
-        # randomly pick start coordinates
-        i = torch.randint(nonzero.shape[0], (1,))[0]
-        _, r_y, r_x = nonzero[i]
-
-        if r_h_half is None and r_w_half is None:
-            # if size is not provided randomly generate
-            r_h_half = torch.randint(int(h * 0.02), int(h * 0.05), size=(1,))[0]
-            r_w_half = torch.randint(int(w * 0.02), int(w * 0.05), size=(1,))[0]
-
-        # get coords from center coord + rectangle half
-        x1 = int(torch.clamp(r_x - r_w_half, min=0))
-        y1 = int(torch.clamp(r_y - r_h_half, min=0))
-        x2 = int(torch.clamp(r_x + r_w_half, max=w))
-        y2 = int(torch.clamp(r_y + r_h_half, max=h))
+def sample_centers(allowed):
+    """
+    Sample one center per image uniformly from the allowed positions, without rejection
 
-        # cut is ok if size matches to 0.001 deciaml
-        cut_ok = abs((y2 - y1) - r_h_half * 2) < 0.001
-        cut_ok &= abs((x2 - x1) - r_w_half * 2) < 0.001
+    Args:
+        allowed: [B, H, W] mask of allowed centers
 
-    # return coords and half size
-    return x1, y1, x2, y2, r_w_half, r_h_half
\ No newline at end of file
+    Returns:
+        center rows [B], center columns [B] and [B] mask of images that had an allowed position
+    """
+    b, _, w = allowed.shape
+    weights = allowed.flatten(1).float()
+    has_any = weights.sum(dim=1) > 0
+    # multinomial needs a positive row, images without allowed positions are masked out
+    weights[~has_any, 0] = 1
+    idx = torch.multinomial(weights, 1)[:, 0]
+    return idx // w, idx % w, has_any
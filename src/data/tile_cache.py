@@ -0,0 +1,193 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import tv_tensors
+from torch.utils.data import Dataset
+
+from .dataset import RiverDebrisDataset
+from .scuffed_mixup import ScuffedMix
+from .tiler import Tiler
+
+
+def build_tile_cache(img_root, mask_root, cache_root, img_size, tile_size):
+    """
+    Decode, resize and tile every image and river mask once and store the tiles
+    as arrays that can be memory mapped. Images are resized as floats exactly like
+    `RiverDebrisDataset` and stored rounded in their integer source dtype, so 16-bit
+    images keep their range.
+
+    Layout of `cache_root`:
+        images.npy: [N, t_dim_h * t_dim_w, C, t_h, t_w] image tiles in the source dtype
+        masks.npy: [N, t_dim_h * t_dim_w, 1, t_h, t_w] uint8 river mask tiles, 1 where river
+        index.json: image names, image and tile size and the image dtype
+
+    Args:
+        img_root (Path): path to dir containing images
+        mask_root (Path): path to dir containing masks
+        cache_root (Path): path to output dir
+        img_size (tuple[int, int]): size the images are resized to
+        tile_size (tuple[int, int]): tile size
+    """
+    cache_root = Path(cache_root)
+    cache_root.mkdir(parents=True, exist_ok=True)
+    # reuse the dataset for file matching and tiling
+    dataset = RiverDebrisDataset(img_root, mask_root, img_size, tile_size)
+
+    images, masks, dtype = None, None, None
+    for i, (img_path, mask_path) in enumerate(zip(dataset.image_paths, dataset.mask_paths)):
+        print(f"caching {img_path}...")
+        image = tv_tensors.Image(Image.open(img_path))
+        if image.is_floating_point():
+            raise ValueError(f"{img_path}: the tile cache needs integer images, got {image.dtype}")
+        if dtype is None:
+            dtype = image.numpy().dtype
+        elif image.numpy().dtype != dtype:
+            raise ValueError(f"{img_path}: expected {dtype} like the other images, got {image.numpy().dtype}")
+        river_mask = tv_tensors.Mask(
+            tv_tensors.Mask(Image.open(mask_path).convert("L")) == 0, dtype=torch.float32
+        )
+        # same scaling and resizing as the uncached dataset
+        image, river_mask = dataset.transform(image, river_mask)
+        img_tiles, river_mask_tiles = dataset.tiler.tile(image), dataset.tiler.tile(river_mask)
+
+        if images is None:
+            # the tile count and shape are fixed by the image size, allocate everything up front
+            n = len(dataset.image_paths)
+            images = np.lib.format.open_memmap(
+                cache_root / "images.npy", "w+", dtype, (n, *img_tiles.shape)
+            )
+            masks = np.lib.format.open_memmap(
+                cache_root / "masks.npy", "w+", np.uint8, (n, *river_mask_tiles.shape)
+            )
+        images[i] = (img_tiles * np.iinfo(dtype).max).round().numpy().astype(dtype)
+        masks[i] = river_mask_tiles.numpy().astype(np.uint8)
+
+    if images is not None:
+        images.flush()
+        masks.flush()
+        np.save(cache_root / "river_tiles.npy", river_tile_index(masks))
+    with open(cache_root / "index.json", "w") as f:
+        json.dump({
+            "names": [p.stem for p in dataset.image_paths],
+            "img_size": list(img_size),
+            "tile_size": list(tile_size),
+            "dtype": np.dtype(dtype or np.uint8).name,
+        }, f)
+
+
+def river_tile_index(masks):
+    """
+    Find the tiles that contain river.
+
+    Args:
+        masks (np.ndarray): river mask tiles of shape [N, t_dim_h * t_dim_w, 1, t_h, t_w]
+
+    Returns:
+        [K, 2] array of (image index, tile index) pairs
+    """
+    # one image at a time so the memory map is never read at once
+    return np.concatenate([
+        np.stack([np.full(len(tiles), i), tiles], axis=1)
+        for i, tiles in enumerate(
+            np.flatnonzero(image_masks.reshape(len(image_masks), -1).any(axis=1))
+            for image_masks in masks
+        )
+    ]).astype(np.int64)
+
+
+class TileCache:
+    """
+    Lazily memory maps a tile cache written by `build_tile_cache`. The arrays are
+    opened on first access so every data loader worker maps them itself.
+
+    Args:
+        cache_root (Path): path to the cache dir
+    """
+
+    def __init__(self, cache_root):
+        self.cache_root = Path(cache_root)
+        with open(self.cache_root / "index.json") as f:
+            self.index = json.load(f)
+        self._images, self._masks = None, None
+        # caches written before the dtype was recorded are uint8
+        self.scale = np.iinfo(self.index.get("dtype", "uint8")).max
+
+    def __len__(self):
+        return len(self.index["names"])
+
+    @property
+    def images(self):
+        if self._images is None:
+            # copy-on-write mapping so torch can wrap it without copying
+            self._images = np.load(self.cache_root / "images.npy", mmap_mode="c")
+        return self._images
+
+    @property
+    def masks(self):
+        if self._masks is None:
+            self._masks = np.load(self.cache_root / "masks.npy", mmap_mode="c")
+        return self._masks
+
+    def river_tiles(self):
+        """(image index, tile index) pairs of the tiles that contain river."""
+        index_path = self.cache_root / "river_tiles.npy"
+        if index_path.exists():
+            return np.load(index_path)
+        return river_tile_index(self.masks)
+
+
+class CachedRiverDebrisDataset(RiverDebrisDataset):
+    """
+    RiverDebrisDataset reading preprocessed tiles from a tile cache,
+    only the random augmentation runs per epoch.
+
+    Args:
+        cache_root (Path): path to the cache dir written by `build_tile_cache`
+    """
+
+    def __init__(self, cache_root):
+        # image files are not needed, only the tiler and the augmentation
+        Dataset.__init__(self)
+        self.cache = TileCache(cache_root)
+        self.tiler = Tiler(self.cache.index["img_size"], self.cache.index["tile_size"])
+        self.mix = ScuffedMix()
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __getitem__(self, index):
+        # zero-copy views of the memory mapped tiles
+        img_tiles = torch.from_numpy(self.cache.images[index])
+        river_mask_tiles = torch.from_numpy(self.cache.masks[index])
+        return self.augment(img_tiles.float() / self.cache.scale, river_mask_tiles.float())
+
+
+class RiverDebrisTileDataset(CachedRiverDebrisDataset):
+    """
+    Tile-level dataset over the river tiles of a tile cache. Every item is a
+    single tile, so tiles of all images are shuffled together and batches
+    have a fixed shape.
+
+    Args:
+        cache_root (Path): path to the cache dir written by `build_tile_cache`
+    """
+
+    def __init__(self, cache_root):
+        super().__init__(cache_root)
+        self.river_tiles = self.cache.river_tiles()
+
+    def __len__(self):
+        return len(self.river_tiles)
+
+    def __getitem__(self, index):
+        img_idx, tile_idx = self.river_tiles[index]
+        img_tile = torch.from_numpy(self.cache.images[img_idx, tile_idx])
+        river_mask_tile = torch.from_numpy(self.cache.masks[img_idx, tile_idx])
+        # [C, H, W], [1, H, W]
+        mix_img_tiles, debris_mask_tiles, cls_labels = self.augment(
+            img_tile[None].float() / self.cache.scale, river_mask_tile[None].float(), river_only=False
+        )
+        return mix_img_tiles[0], debris_mask_tiles[0], cls_labels[0]
@@ -1,8 +1,36 @@
+import math
+
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torchvision.transforms import Resize
 
 
+def blend_window(tile_size: tuple[int, int], kind: str = "cosine"):
+    """
+    Weights used to blend overlapping tiles, highest in the tile center.
+
+    Args:
+        tile_size (tuple[int, int]): tile size
+        kind (str): one of "uniform", "cosine" (Hann) or "gaussian"
+
+    Returns:
+        weights of shape [t_h, t_w], strictly positive
+    """
+    def window_1d(n):
+        # sample at pixel centers so the border weights stay positive
+        i = torch.arange(n, dtype=torch.float32) + 0.5
+        if kind == "uniform":
+            return torch.ones(n)
+        if kind == "cosine":
+            return torch.sin(math.pi * i / n) ** 2
+        if kind == "gaussian":
+            return torch.exp(-0.5 * ((i - n / 2) / (n / 8)) ** 2)
+        raise ValueError(f"Unknown blend window: {kind}")
+
+    return torch.outer(*[window_1d(n) for n in tile_size])
+
+
 class Tiler:
     """
     Tiler class to split the image into smaller tiles
@@ -10,64 +38,104 @@ class Tiler:
     Args:
         in_size (tuple[int, int]): input image size
         tile_size (tuple[int, int]): tile size
+        stride (tuple[int, int]): (optional) distance between tiles, smaller than
+            the tile size for overlapping tiles. Defaults to the tile size.
+        window (str): (optional) blend window for overlapping tiles, see `blend_window`.
+            Defaults to "uniform" without overlap and "cosine" with overlap.
 
+    Images whose size is not covered by the tiles are zero padded on the bottom
+    and right, the padding is cropped away again in `untile`.
     """
 
-    def __init__(self, in_size: tuple[int, int], tile_size: tuple[int, int]):
-        self.tile_count = []
-        for in_dim, tile_dim in zip(in_size, tile_size):
-            assert in_dim % tile_dim == 0, "Image size must be divisible by tile size"
-            self.tile_count.append(in_dim // tile_dim)
-
-        self.tile_size = tile_size
+    def __init__(self, in_size: tuple[int, int], tile_size: tuple[int, int],
+                 stride: tuple[int, int] = None, window: str = None):
+        stride = tuple(stride or tile_size)
 
-        self.unfolder = nn.Unfold(kernel_size=tile_size, stride=tile_size)
-        self.folder = torch.nn.Fold(output_size=in_size, kernel_size=tile_size, stride=tile_size)
+        self.tile_count = []
+        self.pad_size = []
+        for in_dim, tile_dim, stride_dim in zip(in_size, tile_size, stride):
+            assert 0 < stride_dim <= tile_dim, "Stride must be positive and at most the tile size"
+            count = max(math.ceil((in_dim - tile_dim) / stride_dim), 0) + 1
+            self.tile_count.append(count)
+            self.pad_size.append((count - 1) * stride_dim + tile_dim)
+
+        self.in_size = tuple(in_size)
+        self.tile_size = tuple(tile_size)
+        self.stride = stride
+
+        self.unfolder = nn.Unfold(kernel_size=tile_size, stride=stride)
+        self.folder = nn.Fold(output_size=self.pad_size, kernel_size=tile_size, stride=stride)
+
+        if window is None:
+            window = "uniform" if stride == self.tile_size else "cosine"
+        # [t_h, t_w] blend weights and [1, 1, H_pad, W_pad] sum of weights for normalization
+        self.weight = blend_window(tile_size, window)
+        t_c_h, t_c_w = self.tile_count
+        self.norm = self.folder(self.weight.reshape(1, -1, 1).repeat(1, 1, t_c_h * t_c_w))
 
     def tile(self, img: torch.Tensor):
         """
         Tile the passed images into specified tiles.
 
         Args:
-            img (torch.Tensor): input images of shape [C, H, W]
+            img (torch.Tensor): input images of shape [C, H, W] or [B, C, H, W]
 
         Returns:
             tiled image in shape: [t_dim_h * t_dim_w, C, t_h, t_w]
+            or [B, t_dim_h * t_dim_w, C, t_h, t_w] for batched input
         """
-        assert len(img.shape) == 3, "Tiler only supports non-batched input"
+        assert img.dim() in (3, 4), "Tiler only supports [C, H, W] or [B, C, H, W] input"
+        assert tuple(img.shape[-2:]) == self.in_size, "Image size does not match the tiler"
+        batched = img.dim() == 4
+        if not batched:
+            img = img[None]
 
         # tile height, tile width
         t_h, t_w = self.tile_size
         # vertical tile count, tile count horizontal
         t_c_h, t_c_w = self.tile_count
 
-        # [C * t_h * t_w, total_tile_count]
+        # pad bottom and right so the tiles cover the whole image
+        pad_h, pad_w = self.pad_size[0] - self.in_size[0], self.pad_size[1] - self.in_size[1]
+        img = F.pad(img, (0, pad_w, 0, pad_h))
+
+        # [B, C * t_h * t_w, total_tile_count]
         tiles = self.unfolder(img)
-        # [C, t_h, t_w, total_tile_count] -> [total_tile_count, C, t_h, t_w]
-        tiles = tiles.view(-1, t_h, t_w, t_c_h * t_c_w).permute(3, 0, 1, 2)
+        # [B, C, t_h, t_w, total_tile_count] -> [B, total_tile_count, C, t_h, t_w]
+        tiles = tiles.view(img.shape[0], -1, t_h, t_w, t_c_h * t_c_w).permute(0, 4, 1, 2, 3)
 
-        return tiles
+        return tiles if batched else tiles[0]
 
     def untile(self, tiles: torch.Tensor):
         """
-        Assemble the tiles back into full image.
+        Assemble the tiles back into full image. Overlapping tiles are
+        blended with the weighted average of the blend window.
 
         Args:
             tiles (torch.Tensor): tiles of shape [t_dim_h * t_dim_w, C, t_h, t_w]
+                or [B, t_dim_h * t_dim_w, C, t_h, t_w]
 
         Returns:
-            reassembled image in shape: [C, H, W]
+            reassembled image in shape: [C, H, W] or [B, C, H, W] for batched input
         """
+        batched = tiles.dim() == 5
+        if not batched:
+            tiles = tiles[None]
+
         # tile height, tile width
         t_h, t_w = self.tile_size
         # vertical tile count, tile count horizontal
         t_c_h, t_c_w = self.tile_count
 
-        # [total_tile_count, C, t_h, t_w] -> [C, t_h, t_w, total_tile_count]
-        tiles = tiles.permute(1, 2, 3, 0).view(-1, t_c_h * t_c_w)
-        untiled = self.folder(tiles)
+        # [B, total_tile_count, C, t_h, t_w] -> [B, C * t_h * t_w, total_tile_count]
+        tiles = tiles * self.weight.to(tiles)
+        tiles = tiles.permute(0, 2, 3, 4, 1).reshape(tiles.shape[0], -1, t_c_h * t_c_w)
+        untiled = self.folder(tiles) / self.norm.to(tiles)
+
+        # crop the padding
+        untiled = untiled[..., :self.in_size[0], :self.in_size[1]]
 
-        return untiled
+        return untiled if batched else untiled[0]
 
 
 if __name__ == '__main__':
@@ -87,6 +155,15 @@ if __name__ == '__main__':
 
     assert (img == untiled).all()
 
+    # overlapping tiles of an image that is not divisible by the tile size
+    overlap_tiler = Tiler(in_size=(1000, 750), tile_size=(256, 256), stride=(192, 192))
+    overlap_img = img[:, :1000, :750]
+    assert torch.allclose(overlap_img, overlap_tiler.untile(overlap_tiler.tile(overlap_img)), atol=1e-3)
+
+    # batched tiling
+    batch = torch.stack([img, img.flip(-1)])
+    assert (batch == tiler.untile(tiler.tile(batch))).all()
+
     fig, axs = plt.subplots(4, 3)
     for i in range(4):
         for j in range(3):
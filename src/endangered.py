@@ -0,0 +1,67 @@
+import os
+import threading
+import time
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from shapely import STRtree
+
+
+class EndangeredAreas:
+    """Endangered areas layer kept in memory behind an STRtree spatial index.
+    The layer is reloaded when its files change on disk.
+
+    Args:
+        path (str): Path to the endangered areas file or directory
+        check_interval (float): Minimum seconds between checks for changes on disk
+    """
+
+    def __init__(self, path, check_interval=10):
+        self.path = Path(path)
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self._load()
+
+    def _mtime(self):
+        if self.path.is_dir():
+            mtime = max((os.path.getmtime(p) for p in self.path.iterdir()), default=None)
+            if mtime is None:
+                raise FileNotFoundError(f'{self.path} has no endangered area files')
+            return mtime
+        return os.path.getmtime(self.path)
+
+    def _load(self):
+        self.mtime = self._mtime()
+        self.checked = time.monotonic()
+        # query points are lat/lon so keep the polygons in the same CRS
+        areas = gpd.read_file(self.path).to_crs("EPSG:4326")
+        self.tree = STRtree(areas.geometry.values)
+
+    def reload_if_changed(self):
+        """Reloads the layer if it changed since it was loaded."""
+        with self.lock:
+            if time.monotonic() - self.checked < self.check_interval:
+                return
+            self.checked = time.monotonic()
+            if self._mtime() != self.mtime:
+                print(f'Reloading endangered areas from {self.path}')
+                self._load()
+
+    def contains(self, longitudes, latitudes):
+        """Checks which points lie inside an endangered area.
+
+        Args:
+            longitudes (array-like): Longitudes of the points
+            latitudes (array-like): Latitudes of the points
+
+        Returns:
+            np.ndarray: Boolean array, True for points in an endangered area
+        """
+        self.reload_if_changed()
+        points = shapely.points(np.asarray(longitudes, dtype=float), np.asarray(latitudes, dtype=float))
+        point_idx, _ = self.tree.query(points, predicate="within")
+        is_endangered = np.zeros(len(points), dtype=bool)
+        is_endangered[point_idx] = True
+        return is_endangered
@@ -0,0 +1,50 @@
+from argparse import ArgumentParser
+from pathlib import Path
+
+import torch
+
+from models import RiverDebrisModel
+from models.model import DebrisPredictor
+
+if __name__ == "__main__":
+    parser = ArgumentParser("Export")
+    parser.add_argument(
+        "--checkpoint_path", type=Path, help="Path to checkpoint."
+    )
+    parser.add_argument(
+        "--out_path", type=Path, help="Path of the exported model, .pt for TorchScript or .onnx."
+    )
+    parser.add_argument(
+        "--channels", type=int, default=3,
+        help="Number of image channels."
+    )
+    parser.add_argument(
+        "--tile_size", type=int, default=256,
+        help="Tile size the model is traced with."
+    )
+    args = parser.parse_args()
+    assert args.out_path.suffix in (".pt", ".ts", ".onnx"), "Output must be .pt or .ts for TorchScript, or .onnx"
+
+    # only the network weights are kept, optimizer and trainer state are dropped
+    model = RiverDebrisModel.load_from_checkpoint(args.checkpoint_path, map_location="cpu")
+    predictor = DebrisPredictor(model.model).eval().requires_grad_(False)
+
+    example = (
+        torch.rand(1, args.channels, args.tile_size, args.tile_size),
+        torch.ones(1, 1, args.tile_size, args.tile_size),
+    )
+    with torch.no_grad():
+        # materialize any lazy modules before tracing
+        predictor(*example)
+
+        if args.out_path.suffix == ".onnx":
+            torch.onnx.export(
+                predictor, example, args.out_path,
+                input_names=["x", "river_mask"], output_names=["debris"],
+                dynamic_axes={"x": {0: "batch"}, "river_mask": {0: "batch"}, "debris": {0: "batch"}},
+                opset_version=17
+            )
+        else:
+            traced = torch.jit.freeze(torch.jit.trace(predictor, example))
+            traced.save(str(args.out_path))
+    print(f"exported {args.out_path}")
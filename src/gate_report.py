@@ -0,0 +1,128 @@
+import json
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import torch
+
+from data.dataset import RiverDebrisPredDataset
+from inference import load_model, set_threads
+from predict import batched
+
+
+def run(model, batches, gate_threshold):
+    """
+    Predict all batches with the given gate.
+
+    Returns:
+        tuple of predictions [N, 1, H, W] and seconds per tile
+    """
+    model.gate_threshold = gate_threshold
+    # warm up so one-time allocations are not timed
+    model.predict_tiles(*batches[0])
+    model.reset_stats()
+    start = time.perf_counter()
+    preds = torch.cat([model.predict_tiles(x, river_mask) for x, river_mask in batches])
+    return preds, (time.perf_counter() - start) / len(preds)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("Tile gate report")
+    parser.add_argument(
+        "--img_root", type=Path, help="Path to dir containing held-out images."
+    )
+    parser.add_argument(
+        "--mask_root", type=Path, help="Path to dir containing masks."
+    )
+    parser.add_argument(
+        "--checkpoint_path", type=Path, help="Path to checkpoint trained with --cls_head."
+    )
+    parser.add_argument(
+        "--thresholds", type=float, nargs="+", default=[0.05, 0.1, 0.2, 0.3, 0.5],
+        help="Gate thresholds to compare against the ungated model."
+    )
+    parser.add_argument(
+        "--num_tiles", type=int, default=512,
+        help="Number of river tiles with synthetic debris to evaluate on."
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=16,
+        help="Tiles per forward pass."
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=0.5,
+        help="Debris probability threshold of a debris pixel."
+    )
+    parser.add_argument(
+        "--intra_op_threads", type=int, default=None,
+        help="Threads used inside an operator."
+    )
+    parser.add_argument(
+        "--seed", type=int, default=1337,
+        help="RNG seed of the synthetic debris."
+    )
+    parser.add_argument(
+        "--out_path", type=Path, default=Path("gate_report.json"),
+        help="Path of the JSON report."
+    )
+    args = parser.parse_args()
+
+    set_threads(args.intra_op_threads)
+    torch.manual_seed(args.seed)
+    model = load_model(args.checkpoint_path)
+    assert model.model.cls is not None, f"{args.checkpoint_path} has no tile classifier"
+
+    # river tiles of the held-out images with the synthetic debris used in training
+    dataset = RiverDebrisPredDataset(args.img_root, args.mask_root, (2048, 2048), (256, 256))
+    images, river_masks, labels = [], [], []
+    for img_tiles, river_mask_tiles in dataset:
+        mix_img_tiles, _, cls_labels = dataset.augment(img_tiles, river_mask_tiles, river_only=False)
+        keep = river_mask_tiles.flatten(1).any(dim=1)
+        images.extend(mix_img_tiles[keep])
+        river_masks.extend(river_mask_tiles[keep])
+        labels.extend(cls_labels[keep])
+        if len(images) >= args.num_tiles:
+            break
+    labels = torch.stack(labels[:args.num_tiles]).bool()
+    batches = [
+        (torch.stack(x), torch.stack(m)) for x, m in zip(
+            batched(images[:args.num_tiles], args.batch_size),
+            batched(river_masks[:args.num_tiles], args.batch_size)
+        )
+    ]
+    print(f"evaluating on {len(labels)} tiles, {int(labels.sum())} with debris...")
+
+    # classifier probabilities of every tile
+    with torch.inference_mode():
+        probs = torch.cat([
+            torch.sigmoid(model.model.cls(model.model.seg.encode(x)[0]))[:, 0] for x, _ in batches
+        ])
+
+    # ungated model as the reference
+    reference, reference_time = run(model, batches, None)
+    ref_mask = reference >= args.threshold
+
+    report = {
+        "threads": torch.get_num_threads(),
+        "tiles": len(labels),
+        "debris_tiles": int(labels.sum()),
+        "reference_ms_per_tile": reference_time * 1000,
+        "thresholds": {},
+    }
+    for threshold in args.thresholds:
+        flagged = probs >= threshold
+        preds, tile_time = run(model, batches, threshold)
+        pred_mask = preds >= args.threshold
+        report["thresholds"][str(threshold)] = {
+            "ms_per_tile": tile_time * 1000,
+            "speedup": reference_time / tile_time,
+            "decoded_ratio": float(flagged.float().mean()),
+            "tile_recall": float((flagged & labels).sum() / labels.sum()) if labels.any() else 1.0,
+            "tile_precision": float((flagged & labels).sum() / flagged.sum()) if flagged.any() else 1.0,
+            # debris pixels of the ungated model that survive the gate
+            "pixel_recall_vs_ungated": float((pred_mask & ref_mask).sum() / ref_mask.sum()) if ref_mask.any() else 1.0,
+        }
+        print(threshold, json.dumps(report["thresholds"][str(threshold)]))
+
+    with open(args.out_path, "w") as f:
+        json.dump(report, f, indent=2)
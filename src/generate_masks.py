@@ -1,78 +1,233 @@
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import multiprocessing
 import geopandas as gpd
-import matplotlib.pyplot as plt
 from PIL import Image
 import rasterio
+from rasterio import features
+from rasterio.warp import transform_bounds
+from shapely import STRtree
 from shapely.geometry import box
-import io
 import os
 from argparse import ArgumentParser
 import numpy as np
 
-parser = ArgumentParser("Mask generation")
-parser.add_argument(
-    "img_root", type=Path, help="Path to dir containing images."
-)
-parser.add_argument(
-    "seg_path", type=Path, help="Path to river segmentation file."
-)
-parser.add_argument(
-    "out_root", type=Path, help="Path to output dir."
-)
-args = parser.parse_args()
-
-dataset_path = args.img_root
-seg_path = args.seg_path
-out_path = args.out_root
-
-os.makedirs(out_path, exist_ok=True)
-
-print("reading segmentation file...")
-seg = gpd.read_file(seg_path)
-seg = seg.drop(['ID_REG_HOB', 'HOBMPV_ID', 'HOBMPV_IM', 'VERZIJA', 'DATP_ZAC',
-       'DATP_KON', 'RAZVOJ', 'JEZIK', 'DAT_ZAC', 'DAT_KON', 'IME_ID', 'IME',
-       'VRSTA_ID', 'VRSTA_IM', 'TIPSV_ID', 'TIPSV_IM', 'TIPTV_ID', 'TIPTV_IM',
-       'TIPPREH_ID', 'TIPPREH_IM', 'IZVOR_ID', 'IZVOR_IM', 'STALN_ID',
-       'STALN_IM', 'STANJE_ID', 'STANJE_IM', 'POTEK_ID', 'POTEK_IM',
-       'SIRINA_ID', 'SIRINA_IM', 'VIRP_ID', 'VIRP_IM', 'PREOB_ID', 'PREOB_IME',
-       'VODE_ID', 'HMZ_ID', 'NADM_V', 'DVIRP', 'SIMBOL', 'SHAPE_AREA',
-       'SHAPE_LEN'], axis=1).to_crs("EPSG:4326")
-print("done")
-
-for img_path in dataset_path.glob("*.tif"):
-    print(f"reading image {str(img_path)}...")
-    
-    # read geo bbox
-    img = rasterio.open(img_path)
-    bbox = box(*img.bounds)
-    bbox_df = gpd.GeoDataFrame({"geometry":[bbox]})
-    bbox_df = bbox_df.set_crs(img.crs.to_dict())
-    bbox_df = bbox_df.to_crs("EPSG:4326")
-    bbox = bbox_df.iloc[0, 0]
-    
-    # get intersects with rivers
-    intersects = seg.intersects(bbox)
-    if not intersects.any():
-        print("no intersections found, skipping.")
-        continue
-
-    # plot the river bboxes
-    buf = io.BytesIO()
-    dpi = 100
-    fig, ax = plt.subplots(figsize=(img.width/dpi, img.height/dpi), dpi=dpi)
-    seg.loc[intersects].plot(ax=ax, color="k")
-    ax.set_xlim(bbox.bounds[0], bbox.bounds[2])
-    ax.set_ylim(bbox.bounds[1], bbox.bounds[3])
-    plt.axis('off')
-    plt.savefig(buf, dpi=dpi, pad_inches=0, bbox_inches="tight")
-
-    # save mask
-    buf.seek(0)
-    mask = Image.open(buf)
-    if (np.array(mask) == 0).mean() < 0.05:
-        continue
-
-    #mask.resize((img.width, img.height))
-    mask.save(out_path / f"{img_path.stem}.png")
-    print("saved mask.")
-    plt.close(fig)
+# river segmentation index, set before the worker pool is forked so workers share it copy-on-write
+RIVERS = None
+
+
+class RiverIndex:
+    """
+    River segmentation geometries in their native CRS behind an STRtree spatial index.
+
+    Args:
+        geometries (array-like): river geometries
+        crs: CRS of the geometries
+    """
+
+    def __init__(self, geometries, crs):
+        self.geometries = np.asarray(geometries)
+        self.crs = crs
+        self.tree = STRtree(self.geometries)
+
+    @classmethod
+    def load(cls, seg_path, cache_path=None):
+        """
+        Load the river segmentation layer. The geometries are cached as GeoParquet
+        so later runs skip the slow shapefile read, the cache is rebuilt when the
+        segmentation file, or any file of a segmentation directory, is newer than it.
+        """
+        if cache_path is not None and cache_path.exists() \
+                and cache_path.stat().st_mtime >= newest_mtime(seg_path):
+            seg = gpd.read_parquet(cache_path)
+        else:
+            seg = read_segmentation(seg_path)
+            if cache_path is not None:
+                seg.to_parquet(cache_path)
+        return cls(seg.geometry.values, seg.crs)
+
+    def query(self, bounds, crs):
+        """
+        Find the rivers intersecting the bounds.
+
+        Args:
+            bounds (tuple): left, bottom, right and top of the query box
+            crs: CRS of the bounds, the result is returned in it as well
+
+        Returns:
+            gpd.GeoSeries of the intersecting rivers
+        """
+        # transform the query box once into the index CRS instead of the whole layer
+        bbox = box(*transform_bounds(crs, self.crs, *bounds))
+        idx = self.tree.query(bbox, predicate="intersects")
+        rivers = gpd.GeoSeries(self.geometries[np.sort(idx)], crs=self.crs)
+        return rivers if rivers.empty else rivers.to_crs(crs)
+
+
+def newest_mtime(path):
+    """
+    Modification time of a file or the newest file under a directory, rewriting a file
+    inside a directory does not change the mtime of the directory itself.
+    """
+    if path.is_dir():
+        return max((p.stat().st_mtime for p in path.rglob("*") if p.is_file()), default=0)
+    return path.stat().st_mtime
+
+
+def read_segmentation(seg_path):
+    """
+    Read the river segmentation layer in its native CRS, only the geometries are kept.
+    """
+    seg = gpd.read_file(seg_path)
+    seg = seg.drop(['ID_REG_HOB', 'HOBMPV_ID', 'HOBMPV_IM', 'VERZIJA', 'DATP_ZAC',
+           'DATP_KON', 'RAZVOJ', 'JEZIK', 'DAT_ZAC', 'DAT_KON', 'IME_ID', 'IME',
+           'VRSTA_ID', 'VRSTA_IM', 'TIPSV_ID', 'TIPSV_IM', 'TIPTV_ID', 'TIPTV_IM',
+           'TIPPREH_ID', 'TIPPREH_IM', 'IZVOR_ID', 'IZVOR_IM', 'STALN_ID',
+           'STALN_IM', 'STANJE_ID', 'STANJE_IM', 'POTEK_ID', 'POTEK_IM',
+           'SIRINA_ID', 'SIRINA_IM', 'VIRP_ID', 'VIRP_IM', 'PREOB_ID', 'PREOB_IME',
+           'VODE_ID', 'HMZ_ID', 'NADM_V', 'DVIRP', 'SIMBOL', 'SHAPE_AREA',
+           'SHAPE_LEN'], axis=1)
+    return seg
+
+
+def generate_mask(img_path, river_index, min_river_ratio=0.05):
+    """
+    Rasterize the rivers intersecting the image onto the image's own pixel grid.
+
+    Args:
+        img_path (Path): path to the georeferenced image
+        river_index (RiverIndex): river segmentation index
+        min_river_ratio (float): masks with less river are discarded
+
+    Returns:
+        uint8 mask of the image's shape, 0 where river and 255 elsewhere,
+        or None if the image does not contain enough river
+    """
+    with rasterio.open(img_path) as img:
+        # get intersects with rivers in the image CRS
+        rivers = river_index.query(img.bounds, img.crs)
+        if rivers.empty:
+            return None
+
+        # burn the rivers in the image CRS
+        mask = features.rasterize(
+            rivers, out_shape=(img.height, img.width), transform=img.transform,
+            fill=255, default_value=0, dtype=np.uint8
+        )
+
+    if (mask == 0).mean() < min_river_ratio:
+        return None
+    return mask
+
+
+def save_mask(img_path, out_path):
+    """
+    Generate and save the mask of an image, used as the worker of the process pool.
+
+    Returns:
+        tuple of image name and status, "processed" or "empty"
+    """
+    mask = generate_mask(img_path, RIVERS)
+    if mask is None:
+        return img_path.name, "empty"
+
+    # write to a temporary file first so interrupted writes are not mistaken for finished masks
+    mask_path = out_path / f"{img_path.stem}.png"
+    tmp_path = mask_path.with_suffix(".png.tmp")
+    Image.fromarray(mask).save(tmp_path, format="PNG")
+    os.replace(tmp_path, mask_path)
+    return img_path.name, "processed"
+
+
+def read_manifest(manifest_path):
+    """
+    Read the manifest of a previous run.
+
+    Returns:
+        dict of image name to manifest entry
+    """
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path) as f:
+        return {entry["image"]: entry for entry in map(json.loads, f)}
+
+
+def is_done(img_path, out_path, manifest):
+    """
+    Check if an image was already handled and did not change since.
+    Images that failed are not done so they are retried.
+    """
+    mtime = img_path.stat().st_mtime
+    mask_path = out_path / f"{img_path.stem}.png"
+    if mask_path.exists() and mask_path.stat().st_mtime >= mtime:
+        return True
+    entry = manifest.get(img_path.name)
+    return entry is not None and entry["status"] == "empty" and entry["mtime"] == mtime
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("Mask generation")
+    parser.add_argument(
+        "img_root", type=Path, help="Path to dir containing images."
+    )
+    parser.add_argument(
+        "seg_path", type=Path, help="Path to river segmentation file."
+    )
+    parser.add_argument(
+        "out_root", type=Path, help="Path to output dir."
+    )
+    parser.add_argument(
+        "--cache_path", type=Path, default=None,
+        help="Path of the GeoParquet cache of the segmentation layer, defaults to next to it."
+    )
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(),
+        help="Number of worker processes."
+    )
+    args = parser.parse_args()
+
+    dataset_path = args.img_root
+    seg_path = args.seg_path
+    out_path = args.out_root
+
+    os.makedirs(out_path, exist_ok=True)
+
+    # skip images handled by a previous run so interrupted jobs resume
+    manifest_path = out_path / "manifest.jsonl"
+    manifest = read_manifest(manifest_path)
+    img_paths = sorted(dataset_path.glob("*.tif"))
+    todo = [p for p in img_paths if not is_done(p, out_path, manifest)]
+    summary = {
+        "processed": [], "empty": [], "failed": [],
+        "skipped": sorted(set(p.name for p in img_paths) - set(p.name for p in todo))
+    }
+    print(f"{len(summary['skipped'])} images already done, {len(todo)} to process.")
+
+    print("reading segmentation file...")
+    cache_path = args.cache_path or seg_path.parent / f"{seg_path.stem}.parquet"
+    RIVERS = RiverIndex.load(seg_path, cache_path)
+    print("done")
+
+    mtimes = {p.name: p.stat().st_mtime for p in todo}
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(args.workers, mp_context=context) as pool, \
+            open(manifest_path, "a") as manifest_file:
+        futures = {pool.submit(save_mask, img_path, out_path): img_path.name for img_path in todo}
+        for future in as_completed(futures):
+            name = futures[future]
+            entry = {"image": name, "mtime": mtimes[name]}
+            try:
+                _, entry["status"] = future.result()
+            except Exception as e:
+                # unreadable or corrupt images are recorded and retried on the next run
+                entry.update(status="failed", error=f"{type(e).__name__}: {e}")
+            summary[entry["status"]].append(name)
+            print(f"{name}: {entry['status']}" + (f" ({entry['error']})" if "error" in entry else ""))
+            manifest_file.write(json.dumps(entry) + "\n")
+            manifest_file.flush()
+
+    # summary of this run next to the manifest of all runs
+    with open(out_path / "summary.json", "w") as f:
+        json.dump(summary, f, indent=2)
+    print(", ".join(f"{status} {len(names)}" for status, names in summary.items()))
@@ -0,0 +1,135 @@
+import copy
+from pathlib import Path
+
+import torch
+
+
+class ExportedModel:
+    """
+    Exported TorchScript artifact with the prediction interface of RiverDebrisModel.
+    Loading it needs neither Lightning nor the checkpoint's training state.
+
+    Args:
+        path (Path): path to the artifact written by export_model.py
+        device (str): device to load the model on
+    """
+
+    def __init__(self, path, device="cpu"):
+        self.device = torch.device(device)
+        self.module = torch.jit.load(str(path), map_location=self.device).eval()
+
+    def predict_tiles(self, x, river_mask):
+        """See RiverDebrisModel.predict_tiles."""
+        return self.module(x, river_mask)
+
+
+class OnnxModel:
+    """
+    Exported ONNX artifact run with onnxruntime, with the prediction interface of RiverDebrisModel.
+
+    Args:
+        path (Path): path to the .onnx artifact written by export_model.py
+        device (str): "cpu" or "cuda", CUDA needs the onnxruntime-gpu build
+    """
+
+    def __init__(self, path, device="cpu"):
+        # onnxruntime is only needed for ONNX artifacts
+        import onnxruntime as ort
+        self.device = torch.device(device)
+        providers = ["CUDAExecutionProvider"] if self.device.type == "cuda" else []
+        self.session = ort.InferenceSession(str(path), providers=providers + ["CPUExecutionProvider"])
+
+    def predict_tiles(self, x, river_mask):
+        """See RiverDebrisModel.predict_tiles."""
+        (pred,) = self.session.run(None, {
+            "x": x.detach().cpu().numpy(),
+            "river_mask": river_mask.detach().cpu().numpy(),
+        })
+        return torch.from_numpy(pred).to(self.device)
+
+
+def load_model(path, device="cpu"):
+    """
+    Load a model for inference, either an exported artifact or a Lightning checkpoint.
+
+    Args:
+        path (Path): path to a TorchScript artifact (`.pt`), an ONNX artifact (`.onnx`)
+            or a `.ckpt` checkpoint
+        device (str): device to load the model on
+
+    Returns:
+        model in inference mode with a `predict_tiles` method
+    """
+    suffix = Path(path).suffix
+    if suffix == ".onnx":
+        return OnnxModel(path, device)
+    if suffix in (".pt", ".ts"):
+        return ExportedModel(path, device)
+    if suffix != ".ckpt":
+        raise ValueError(f"Unknown model format {suffix}, expected .ckpt, .pt or .onnx")
+
+    # only import Lightning when it is actually needed
+    from models import RiverDebrisModel
+    model = RiverDebrisModel.load_from_checkpoint(path, map_location=device)
+    return model.eval().requires_grad_(False)
+
+
+def set_threads(intra_op=None, inter_op=None):
+    """
+    Set the CPU thread pools, must be called before the first parallel operation.
+
+    Args:
+        intra_op (int): threads used inside an operator, e.g. a convolution
+        inter_op (int): threads used to run independent operators in parallel
+    """
+    if intra_op:
+        torch.set_num_threads(intra_op)
+    if inter_op:
+        torch.set_num_interop_threads(inter_op)
+
+
+class CPUModel:
+    """
+    CPU optimized inference with the prediction interface of RiverDebrisModel.
+
+    Args:
+        model: RiverDebrisModel or ExportedModel, ONNX artifacts are run with OnnxModel instead
+        precision (str): "fp32", "bf16" (autocast) or "int8" (static quantization,
+            needs a RiverDebrisModel and calibration tiles)
+        channels_last (bool): run the convolutions in channels-last memory format
+        calibration (iterable): image tile batches of shape [B, C, H, W] for int8
+        gate_threshold (float): (optional) only decode the tiles the tile classifier flags,
+            needs a RiverDebrisModel trained with a classifier
+    """
+
+    def __init__(self, model, precision="fp32", channels_last=True, calibration=None, gate_threshold=None):
+        assert precision in ("fp32", "bf16", "int8"), f"Unknown precision: {precision}"
+        self.device = torch.device("cpu")
+        self.precision = precision
+        self.channels_last = channels_last
+
+        if isinstance(model, OnnxModel):
+            raise ValueError("CPU optimized inference runs torch models, use the checkpoint or a TorchScript export")
+        if isinstance(model, ExportedModel):
+            assert precision != "int8", "int8 quantization needs the checkpoint, not an exported model"
+            assert gate_threshold is None, "Tile gating needs the checkpoint, not an exported model"
+            self.predictor = model.module
+        else:
+            from models.model import DebrisPredictor
+            net = model.model
+            if precision == "int8":
+                from models.quantize import quantize_unet
+                net = copy.deepcopy(net)
+                net.seg = quantize_unet(net.seg, calibration)
+            self.predictor = DebrisPredictor(net, gate_threshold).eval().cpu()
+
+        if channels_last:
+            self.predictor = self.predictor.to(memory_format=torch.channels_last)
+
+    @torch.inference_mode()
+    def predict_tiles(self, x, river_mask):
+        """See RiverDebrisModel.predict_tiles."""
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        with torch.autocast("cpu", dtype=torch.bfloat16, enabled=self.precision == "bf16"):
+            return self.predictor(x, river_mask).float()
@@ -0,0 +1,146 @@
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted while the queue is at capacity."""
+
+
+@contextmanager
+def stage(timings, name):
+    """Records the duration of a pipeline stage in milliseconds."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = (time.perf_counter() - start) * 1000
+
+
+class JobQueue:
+    """Runs jobs on a bounded worker pool in the background and keeps their results.
+
+    Args:
+        run_job (callable): Called as run_job(payload, timings) in a worker thread, fills
+            the timings dict with per-stage durations and returns the job result
+        max_workers (int): Number of jobs running concurrently
+        max_queued (int): Maximum number of waiting jobs, further submissions are rejected
+        keep_finished (float): Seconds finished jobs are kept for clients to fetch
+    """
+
+    def __init__(self, run_job, max_workers=2, max_queued=32, keep_finished=3600):
+        self.run_job = run_job
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.keep_finished = keep_finished
+        self.pool = ThreadPoolExecutor(max_workers, thread_name_prefix='job')
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.counts = defaultdict(int)
+        self.stage_totals = defaultdict(float)
+        # failed jobs record only the stages they reached, so every stage has its own count
+        self.stage_counts = defaultdict(int)
+
+    def _evict(self):
+        now = time.time()
+        self.jobs = {
+            job_id: job for job_id, job in self.jobs.items()
+            if job['finished'] is None or now - job['finished'] < self.keep_finished
+        }
+
+    def submit(self, payload):
+        """Queues a job.
+
+        Args:
+            payload: Input passed to run_job
+
+        Returns:
+            str: Id of the job
+        """
+        with self.lock:
+            self._evict()
+            if self.counts['queued'] >= self.max_queued:
+                self.counts['rejected'] += 1
+                raise QueueFull(f'{self.counts["queued"]} jobs are already waiting')
+            job_id = uuid.uuid4().hex
+            self.jobs[job_id] = {
+                'id': job_id,
+                'status': 'queued',
+                'submitted': time.time(),
+                'started': None,
+                'finished': None,
+                'timings': {},
+                'result': None,
+                'error': None,
+            }
+            self.counts['queued'] += 1
+        self.pool.submit(self._run, job_id, payload)
+        return job_id
+
+    def _update(self, job_id, **fields):
+        with self.lock:
+            self.jobs[job_id].update(fields)
+            self.changed.notify_all()
+
+    def _run(self, job_id, payload):
+        with self.lock:
+            self.counts['queued'] -= 1
+            self.counts['running'] += 1
+        self._update(job_id, status='running', started=time.time())
+
+        timings = {}
+        try:
+            result = self.run_job(payload, timings)
+        except Exception as e:
+            status, fields = 'failed', {'error': str(e)}
+        else:
+            status, fields = 'done', {'result': result}
+
+        with self.lock:
+            self.counts['running'] -= 1
+            self.counts[status] += 1
+            for name, duration in timings.items():
+                self.stage_totals[name] += duration
+                self.stage_counts[name] += 1
+        self._update(job_id, status=status, finished=time.time(), timings=timings, **fields)
+
+    def get(self, job_id, wait=0):
+        """Returns a copy of the job, optionally waiting for it to finish.
+
+        Args:
+            job_id (str): Id of the job
+            wait (float): Seconds to wait for the job to finish
+
+        Returns:
+            dict: The job or None if it does not exist, the result is shared with the stored
+                job and must not be modified
+        """
+        deadline = time.monotonic() + wait
+        with self.lock:
+            while job_id in self.jobs and self.jobs[job_id]['finished'] is None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                self.changed.wait(timeout)
+            job = self.jobs.get(job_id)
+            return dict(job, timings=dict(job['timings'])) if job else None
+
+    def stats(self):
+        """Returns the queue depth, concurrency and stage timings averaged over the jobs that reached each stage."""
+        with self.lock:
+            return {
+                'queued': self.counts['queued'],
+                'running': self.counts['running'],
+                'done': self.counts['done'],
+                'failed': self.counts['failed'],
+                'rejected': self.counts['rejected'],
+                'max_workers': self.max_workers,
+                'max_queued': self.max_queued,
+                'mean_stage_ms': {
+                    name: total / self.stage_counts[name] for name, total in self.stage_totals.items()
+                },
+            }
@@ -0,0 +1,88 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+from inference import load_model
+
+
+class ModelServer:
+    """Keeps the model loaded for the lifetime of the process and micro-batches
+    concurrent requests into a single forward pass.
+
+    Args:
+        checkpoint_path (str): Path to the Lightning checkpoint or a model exported by export_model.py
+        max_batch_size (int): Maximum number of tiles in one forward pass
+        max_wait (float): Seconds to wait for more requests after the first one arrives
+        device (str): Device to run the model on, defaults to cuda if available
+    """
+
+    def __init__(self, checkpoint_path, max_batch_size=32, max_wait=0.01, device=None):
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.model = load_model(checkpoint_path, self.device)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self._serve, daemon=True)
+        self.worker.start()
+
+    def submit(self, x, river_mask):
+        """Queues tiles for prediction.
+
+        Args:
+            x (torch.Tensor): Image tiles of shape [N, C, H, W]
+            river_mask (torch.Tensor): River mask tiles of shape [N, 1, H, W]
+
+        Returns:
+            Future: Resolves to a tuple of (prediction, metrics) where metrics contains:
+                - queue_ms (float): Time spent waiting for the batch to be formed
+                - inference_ms (float): Duration of the batched forward pass
+                - batch_size (int): Number of tiles in the forward pass
+                - batch_requests (int): Number of requests batched together
+        """
+        future = Future()
+        self.requests.put((x, river_mask, future, time.perf_counter()))
+        return future
+
+    def _next_batch(self):
+        # block for the first request, then collect more until the batch is full or the window closes
+        batch = [self.requests.get()]
+        size = len(batch[0][0])
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                item = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _serve(self):
+        while True:
+            batch = self._next_batch()
+            start = time.perf_counter()
+            try:
+                x = torch.cat([item[0] for item in batch]).to(self.device)
+                river_mask = torch.cat([item[1] for item in batch]).to(self.device)
+                with torch.inference_mode():
+                    preds = self.model.predict_tiles(x, river_mask).cpu()
+            except Exception as e:
+                for *_, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            end = time.perf_counter()
+
+            preds = preds.split([len(item[0]) for item in batch])
+            for (_, _, future, submitted), pred in zip(batch, preds):
+                future.set_result((pred, {
+                    'queue_ms': (start - submitted) * 1000,
+                    'inference_ms': (end - start) * 1000,
+                    'batch_size': len(x),
+                    'batch_requests': len(batch),
+                }))
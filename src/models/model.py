@@ -1,6 +1,5 @@
 import torch
 from torch import nn
-from torchvision.models import resnet18
 
 class UNetBlock(nn.Sequential):
 
@@ -19,25 +18,84 @@ class UNet(nn.Module):
         self.deconvs = nn.ModuleList(nn.ConvTranspose2d(i, o, 2, 2) for i, o in zip(sizes[::-1], sizes[-2::-1]))
         self.conv_out = nn.Conv2d(sizes[0], num_classes, 1)
     
-    def forward(self, x):
+    def encode(self, x):
+        """Returns the bottleneck features and the skip connections for `decode`."""
         skips = []
         for block in self.encoder_blocks[:-1]:
             x = block(x)
             skips.insert(0, x if self.skip else x.shape)
             x = self.pool(x)
-        x = self.encoder_blocks[-1](x)
+        return self.encoder_blocks[-1](x), skips
+
+    def decode(self, x, skips):
         for skip, block, deconv in zip(skips, self.decoder_blocks, self.deconvs):
             x = deconv(x, output_size=skip.shape if self.skip else skip)
             if self.skip: x = torch.cat((skip, x), dim=-3)
             x = block(x)
         return self.conv_out(x)
+
+    def forward(self, x):
+        return self.decode(*self.encode(x))
     
 class SegClsNet(nn.Module):
+    """
+    UNet segmentation with an optional tile classifier on the bottleneck features.
+    The classifier predicts whether a tile contains debris, so the decoder only
+    has to run on the tiles it flags, see `forward_gated`.
 
-    def __init__(self, num_seg_classes, num_cls_classes):
+    Args:
+        num_seg_classes (int): segmentation output channels
+        num_cls_classes (int): classifier outputs, 0 for no classifier
+    """
+
+    def __init__(self, num_seg_classes, num_cls_classes=0):
         super().__init__()
         self.seg = UNet(num_seg_classes)
+        self.cls = nn.Sequential(
+            nn.AdaptiveAvgPool2d(1), nn.Flatten(), nn.Linear(1024, num_cls_classes)
+        ) if num_cls_classes else None
 
     def forward(self, x):
         seg = self.seg(x)
         return seg
+
+    def forward_both(self, x):
+        """Segmentation and classification logits sharing one encoder pass."""
+        features, skips = self.seg.encode(x)
+        return self.seg.decode(features, skips), self.cls(features)
+
+    def forward_gated(self, x, threshold):
+        """
+        Segmentation logits of the tiles whose debris probability is at least `threshold`.
+
+        Returns:
+            segmentation logits of the flagged tiles [K, C, H, W] and the flags [B]
+        """
+        features, skips = self.seg.encode(x)
+        flagged = torch.sigmoid(self.cls(features))[:, 0] >= threshold
+        skips = [skip[flagged] if torch.is_tensor(skip) else skip for skip in skips]
+        return self.seg.decode(features[flagged], skips), flagged
+
+class DebrisPredictor(nn.Module):
+    """
+    Standalone inference graph with the post-processing of
+    RiverDebrisModel.predict_tiles folded in.
+
+    Args:
+        model (SegClsNet): trained network
+        gate_threshold (float): (optional) only decode tiles the classifier flags with at
+            least this probability, the others are predicted clean. Not traceable.
+    """
+
+    def __init__(self, model, gate_threshold=None):
+        super().__init__()
+        self.model = model
+        self.gate_threshold = gate_threshold
+
+    def forward(self, x, river_mask):
+        if self.gate_threshold is None:
+            return (1 - torch.sigmoid(self.model(x))) * river_mask
+        pred = torch.zeros_like(river_mask)
+        seg, flagged = self.model.forward_gated(x, self.gate_threshold)
+        pred[flagged] = ((1 - torch.sigmoid(seg)) * river_mask[flagged]).to(pred.dtype)
+        return pred
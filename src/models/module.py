@@ -1,3 +1,5 @@
+from contextlib import contextmanager
+
 import torch
 from torch import nn
 from torch.nn import functional as F
@@ -9,11 +11,12 @@ from .model import SegClsNet
 
 class RiverDebrisModel(L.LightningModule):
 
-    def __init__(self, lr, *args, **kwargs):
+    def __init__(self, lr, cls_head=False, cls_loss_weight=1.0, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.save_hyperparameters("lr")
+        # checkpoints from before the tile classifier load with cls_head=False
+        self.save_hyperparameters("lr", "cls_head", "cls_loss_weight")
         self.model = SegClsNet(
-            num_cls_classes=1,
+            num_cls_classes=1 if cls_head else 0,
             num_seg_classes=1,
         )
         
@@ -22,6 +25,12 @@ class RiverDebrisModel(L.LightningModule):
 
         self.train_iou = JaccardIndex(task="binary")
         self.train_acc = Accuracy(task="binary")
+
+        # tiles with river coverage at or below this are not passed through the model
+        self.min_river_coverage = 0.0
+        # (optional) river tiles the classifier gives a lower debris probability are not decoded
+        self.gate_threshold = None
+        self.reset_stats()
             
     def configure_optimizers(self):
         optim = torch.optim.Adam(self.model.parameters(), self.hparams.lr)
@@ -32,17 +41,81 @@ class RiverDebrisModel(L.LightningModule):
         }
 
     def training_step(self, batch, batch_idx):
-        x, y_seg = [h[0] for h in batch]
-        pred_seg = self.model(x)
+        x, y_seg, y_cls = batch
+        if x.dim() == 5:
+            # all tiles of one image, [1, N, C, H, W]
+            x, y_seg, y_cls = x[0], y_seg[0], y_cls[0]
 
-        loss = self.loss_fn_seg(pred_seg, y_seg)
+        if self.model.cls is None:
+            pred_seg = self.model(x)
+            loss = self.loss_fn_seg(pred_seg, y_seg)
+        else:
+            pred_seg, pred_cls = self.model.forward_both(x)
+            loss_cls = self.loss_fn_cls(pred_cls[:, 0], y_cls)
+            loss = self.loss_fn_seg(pred_seg, y_seg) + self.hparams.cls_loss_weight * loss_cls
+            self.train_acc(torch.sigmoid(pred_cls[:, 0]), y_cls)
+            self.log(f"train_cls_loss", loss_cls)
+            self.log(f"train_cls_acc", self.train_acc, on_epoch=True, prog_bar=True)
         self.train_iou(pred_seg, y_seg)
 
         self.log(f"train_loss", loss)
         self.log(f"train_iou", self.train_iou, on_epoch=True, prog_bar=True)
         return loss
 
+    def predict_tiles(self, x, river_mask):
+        """
+        Debris probability for a batch of tiles, zero outside the river.
+
+        Args:
+            x (torch.Tensor): image tiles of shape [B, C, H, W]
+            river_mask (torch.Tensor): river mask tiles of shape [B, 1, H, W]
+
+        Returns:
+            debris probability of shape [B, 1, H, W]
+        """
+        # only tiles that contain enough river go through the model, the rest stay zero
+        keep = river_mask.flatten(1).mean(1) > self.min_river_coverage
+        idx = keep.nonzero()[:, 0]
+        pred_seg = torch.zeros_like(river_mask)
+        if len(idx):
+            if self.gate_threshold is None:
+                seg = self.model(x[idx])
+            else:
+                # the decoder only runs on the tiles the classifier flags
+                seg, flagged = self.model.forward_gated(x[idx], self.gate_threshold)
+                self.tiles_gated += int((~flagged).sum())
+                idx = idx[flagged]
+            pred_seg[idx] = (1 - F.sigmoid(seg)) * river_mask[idx]
+
+        self.tiles_seen += len(keep)
+        self.tiles_skipped += int((~keep).sum())
+        return pred_seg
+
+    def reset_stats(self):
+        """Reset the tile counters, called where a prediction run starts."""
+        self.tiles_seen = 0
+        self.tiles_skipped = 0
+        self.tiles_gated = 0
+
+    @contextmanager
+    def untracked(self):
+        """Predictions inside do not count towards the tile counters, e.g. the coarse pass."""
+        counters = self.tiles_seen, self.tiles_skipped, self.tiles_gated
+        try:
+            yield
+        finally:
+            self.tiles_seen, self.tiles_skipped, self.tiles_gated = counters
+
+    @property
+    def skip_ratio(self):
+        """Ratio of predicted tiles that were skipped for not containing river."""
+        return self.tiles_skipped / max(self.tiles_seen, 1)
+
+    @property
+    def gate_ratio(self):
+        """Ratio of river tiles the classifier kept from the decoder."""
+        return self.tiles_gated / max(self.tiles_seen - self.tiles_skipped, 1)
+
     def predict_step(self, batch, batch_idx):
         x, river_mask = [h[0] for h in batch]
-        pred_seg = (1 - F.sigmoid(self.model(x))) * river_mask
-        return pred_seg
+        return self.predict_tiles(x, river_mask)
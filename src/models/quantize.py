@@ -0,0 +1,63 @@
+import copy
+
+import torch
+from torch import nn
+from torch.ao import quantization as tq
+
+
+class QuantizedBlock(nn.Module):
+    """
+    Runs the wrapped modules in int8, converting the input and output to and from float.
+    """
+
+    def __init__(self, body):
+        super().__init__()
+        self.quant = tq.QuantStub()
+        self.body = body
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.body(self.quant(x)))
+
+
+def quantize_unet(unet, calibration, backend="x86"):
+    """
+    Post-training static int8 quantization of the UNet conv blocks.
+
+    The conv + ReLU pairs of every UNetBlock are fused and quantized, the
+    transposed convolutions, skip concatenations and the output conv stay in float.
+    PyTorch only supports dynamic quantization for linear and recurrent layers,
+    so the convolutions are calibrated statically.
+
+    Args:
+        unet (UNet): float model, lazy modules are materialized with the first calibration batch
+        calibration (iterable): image tile batches of shape [B, C, H, W] used to calibrate activation ranges
+        backend (str): quantized engine, "x86", "fbgemm" or "qnnpack"
+
+    Returns:
+        quantized copy of the model
+    """
+    calibration = list(calibration) if calibration is not None else []
+    if not calibration:
+        raise ValueError("int8 quantization needs calibration tiles")
+
+    torch.backends.quantized.engine = backend
+    unet = copy.deepcopy(unet).eval()
+    # loaded LazyConv2d weights only turn into Conv2d on the first forward, fusing needs Conv2d
+    with torch.no_grad():
+        unet(calibration[0][:1])
+    qconfig = tq.get_default_qconfig(backend)
+
+    for blocks in (unet.encoder_blocks, unet.decoder_blocks):
+        for i, block in enumerate(blocks):
+            # UNetBlock is conv, relu, conv, relu
+            body = tq.fuse_modules(block, [["0", "1"], ["2", "3"]])
+            blocks[i] = QuantizedBlock(body)
+            blocks[i].qconfig = qconfig
+
+    tq.prepare(unet, inplace=True)
+    with torch.no_grad():
+        for x in calibration:
+            unet(x)
+    tq.convert(unet, inplace=True)
+    return unet
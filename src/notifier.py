@@ -1,4 +1,8 @@
+import asyncio
 import random
+import time
+import traceback
+from collections import defaultdict
 from typing import Optional
 
 import discord
@@ -6,6 +10,170 @@ import pandas as pd
 from discord import app_commands
 
 MY_GUILD = discord.Object(id=1046387245982175262)
+# Discord rejects longer messages
+MAX_MESSAGE_LENGTH = 2000
+
+
+class TokenBucket:
+    """Allows `rate` events per `per` seconds with bursts of up to `rate` events.
+
+    Args:
+        rate (int): Number of events per period
+        per (float): Length of the period in seconds
+    """
+
+    def __init__(self, rate=5, per=5.0):
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+        self.updated = now
+
+    async def acquire(self):
+        """Waits until an event is allowed and takes its token.
+
+        Returns:
+            float: Seconds waited
+        """
+        waited = 0.0
+        self._refill()
+        while self.tokens < 1:
+            delay = (1 - self.tokens) * self.per / self.rate
+            await asyncio.sleep(delay)
+            waited += delay
+            self._refill()
+        self.tokens -= 1
+        return waited
+
+
+def format_alert(info: dict):
+    """One line summary of an obstacle alert, see `ObstacleNotifier.notify_about_obstacle`."""
+    lat, lon = info['location']
+    return f'- ({lat:.5f}, {lon:.5f}) precipitation {info["precipitation_ratio"]:.2f}, water flow {info["water_flow_ratio"]:.2f}'
+
+
+def split_message(header: str, lines: list, max_length=MAX_MESSAGE_LENGTH):
+    """Joins the lines under the header into as few messages as fit the length limit."""
+    messages, current = [], header
+    for line in lines:
+        if len(current) + 1 + len(line) > max_length:
+            messages.append(current)
+            current = header
+        current += '\n' + line
+    messages.append(current)
+    return messages
+
+
+class AlertDispatcher:
+    """Queues obstacle alerts and sends them as per channel digest messages.
+
+    Alerts arriving within `window` seconds of each other are coalesced into one digest per
+    channel and severity. High severity digests mention everyone and are sent before the
+    others. Every channel has its own token bucket so bursts stay within the Discord rate
+    limit instead of serializing on 429 backoffs. Channels can be any object with an async
+    `send(content)` method.
+
+    Args:
+        window (float): Seconds alerts are collected before a digest is sent
+        rate (int): Messages allowed per channel every `per` seconds
+        per (float): Rate limit period in seconds
+    """
+
+    def __init__(self, window=2.0, rate=5, per=5.0):
+        self.window = window
+        self.rate = rate
+        self.per = per
+        self.pending = defaultdict(list)
+        self.buckets = {}
+        self.arrived = asyncio.Event()
+        self.counts = defaultdict(int)
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def submit(self, channel, alert: dict):
+        """Queues an alert for the channel without waiting for it to be sent.
+
+        Args:
+            channel (discord.abc.Messageable): Channel to send the alert to
+            alert (dict): Alert with the keys of `ObstacleNotifier.notify_about_obstacle` and
+                the severity name under 'severity'
+        """
+        self.pending[channel].append((time.monotonic(), alert))
+        self.counts['queued'] += 1
+        self.arrived.set()
+
+    async def flush(self):
+        """Sends all queued alerts, high severity digests of every channel first."""
+        pending, self.pending = self.pending, defaultdict(list)
+        self.arrived.clear()
+
+        digests = []
+        for channel, alerts in pending.items():
+            high = [item for item in alerts if item[1]['severity'] == 'high']
+            other = [item for item in alerts if item[1]['severity'] != 'high']
+            if high:
+                digests.append((0, channel, high, f'@everyone :warning: *{len(high)} high severity obstacles detected* :warning:'))
+            if other:
+                digests.append((1, channel, other, f'{len(other)} obstacles detected:'))
+        digests.sort(key=lambda digest: digest[0])
+
+        for _, channel, alerts, header in digests:
+            bucket = self.buckets.setdefault(channel, TokenBucket(self.rate, self.per))
+            messages = split_message(header, [format_alert(alert) for _, alert in alerts])
+            sent = True
+            for message in messages:
+                if await bucket.acquire():
+                    self.counts['rate_limited'] += 1
+                try:
+                    await channel.send(message)
+                except Exception as e:
+                    # HTTP errors and anything else the channel raises only fail this digest
+                    print(f'Failed to send alert digest to {channel}: {e!r}')
+                    sent = False
+                    break
+                self.counts['messages'] += 1
+
+            now = time.monotonic()
+            self.counts['queued'] -= len(alerts)
+            self.counts['sent' if sent else 'failed'] += len(alerts)
+            for enqueued, _ in alerts:
+                self.latency_total += now - enqueued
+                self.latency_max = max(self.latency_max, now - enqueued)
+
+    async def run(self):
+        """Sends digests until cancelled, errors are logged and do not stop the loop.
+        The stats are printed when digests fail and on shutdown."""
+        try:
+            while True:
+                await self.arrived.wait()
+                # let the rest of a burst arrive so it goes out in the same digest
+                await asyncio.sleep(self.window)
+                failed = self.counts['failed']
+                try:
+                    await self.flush()
+                except Exception:
+                    traceback.print_exc()
+                if self.counts['failed'] > failed:
+                    print(f'Alert dispatcher: {self.stats()}')
+        finally:
+            print(f'Alert dispatcher stopped: {self.stats()}')
+
+    def stats(self):
+        """Returns the number of queued, sent and failed alerts and their queue latency."""
+        done = self.counts['sent'] + self.counts['failed']
+        return {
+            'queued': self.counts['queued'],
+            'sent': self.counts['sent'],
+            'failed': self.counts['failed'],
+            'messages': self.counts['messages'],
+            'rate_limited': self.counts['rate_limited'],
+            'mean_latency_s': self.latency_total / done if done else None,
+            'max_latency_s': self.latency_max,
+        }
 
 
 class ObstacleNotifier(discord.Client):
@@ -16,10 +184,50 @@ class ObstacleNotifier(discord.Client):
     def __init__(self, intents):
         super().__init__(intents=intents)
         self.tree = app_commands.CommandTree(self)
+        # set before running the bot to forward alerts published by other processes
+        self.alerts = None
+        self.alert_channel_id = None
+        self.alert_tasks = []
+        self.dispatcher = None
 
     async def setup_hook(self):
         self.tree.copy_global_to(guild=MY_GUILD)
         await self.tree.sync(guild=MY_GUILD)
+        if self.alerts is not None:
+            # created here so its event belongs to the bot's event loop
+            self.dispatcher = AlertDispatcher()
+            self.alert_tasks = [
+                asyncio.create_task(self.forward_alerts()),
+                asyncio.create_task(self.dispatcher.run()),
+            ]
+
+    async def resolve_alert_channel(self, delay=5.0, max_delay=300.0):
+        """Returns the alert channel, retrying with backoff until Discord returns it."""
+        while True:
+            channel = self.get_channel(self.alert_channel_id)
+            if channel is not None:
+                return channel
+            try:
+                return await self.fetch_channel(self.alert_channel_id)
+            except Exception as e:
+                print(f'Failed to get alert channel {self.alert_channel_id}, retrying in {delay:.0f}s: {e!r}')
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, max_delay)
+
+    async def forward_alerts(self):
+        """Drains the alert channel and sends the alerts, see `AlertChannel.publish`.
+        Errors are logged and do not stop the loop, so the queue keeps being drained."""
+        await self.wait_until_ready()
+        channel = await self.resolve_alert_channel()
+        while not self.is_closed():
+            try:
+                # the blocking queue read runs in a thread so the event loop keeps serving
+                alerts = await asyncio.to_thread(self.alerts.drain)
+                for alert in alerts:
+                    self.dispatcher.submit(channel, alert)
+            except Exception:
+                traceback.print_exc()
+                await asyncio.sleep(1)
 
     async def notify_about_obstacle(self, info: dict, channel: discord.abc.Messageable, mention_everyone=False, prefix=''):
         """Notifies the users about the obstacle on the water surface.
@@ -0,0 +1,200 @@
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+EARTH_RADIUS = 6371000.0
+METERS_PER_DEGREE = 111320.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS obstacles (
+    id INTEGER PRIMARY KEY,
+    lat REAL NOT NULL,
+    lon REAL NOT NULL,
+    size REAL NOT NULL,
+    area REAL,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    detections INTEGER NOT NULL DEFAULT 1,
+    severity INTEGER
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS obstacles_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+"""
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters between arrays of points in degrees."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+class ObstacleStore:
+    """SQLite store of the obstacles found so far with an R-tree index on their locations.
+    Detections within `distance` meters of an obstacle seen in the last `max_age` seconds
+    are treated as the same obstacle and update its record instead of creating a new one.
+
+    Args:
+        path (str): Path of the database file
+        distance (float): Distance tolerance in meters
+        max_age (float): Time tolerance in seconds, older obstacles are not matched
+        growth (float): Relative size increase after which a matched obstacle is reported as worsened
+    """
+
+    def __init__(self, path, distance=20.0, max_age=7 * 24 * 3600, growth=0.2):
+        self.distance = distance
+        self.max_age = max_age
+        self.growth = growth
+        # shared by the job worker threads, access is serialized with the lock
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    def _match(self, lats, lons, since):
+        """Finds the nearest recent obstacle of every detection.
+
+        Returns:
+            tuple: Arrays of matched obstacle ids (-1 if none), their size and severity (-1 if not scored)
+        """
+        dlat = self.distance / METERS_PER_DEGREE
+        dlon = dlat / np.maximum(np.cos(np.radians(lats)), 1e-6)
+        self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS detections (i INTEGER, lat REAL, lon REAL, dlat REAL, dlon REAL)')
+        self.conn.execute('DELETE FROM temp.detections')
+        self.conn.executemany(
+            'INSERT INTO temp.detections VALUES (?, ?, ?, ?, ?)',
+            zip(range(len(lats)), lats.tolist(), lons.tolist(), [dlat] * len(lats), dlon.tolist())
+        )
+        # one join against the R-tree instead of a query per detection
+        rows = self.conn.execute(
+            """
+            SELECT d.i, o.id, o.lat, o.lon, o.size, COALESCE(o.severity, -1)
+            FROM temp.detections d
+            JOIN obstacles_rtree r ON r.min_lat <= d.lat + d.dlat AND r.max_lat >= d.lat - d.dlat
+                AND r.min_lon <= d.lon + d.dlon AND r.max_lon >= d.lon - d.dlon
+            JOIN obstacles o ON o.id = r.id
+            WHERE o.last_seen >= ?
+            """,
+            (since,)
+        ).fetchall()
+
+        ids = np.full(len(lats), -1, dtype=np.int64)
+        sizes = np.zeros(len(lats))
+        severities = np.full(len(lats), -1, dtype=np.int64)
+        if not rows:
+            return ids, sizes, severities
+        i, obstacle_id, o_lat, o_lon, o_size, o_severity = map(np.array, zip(*rows))
+        dist = haversine(lats[i], lons[i], o_lat, o_lon)
+        within = dist <= self.distance
+        i, obstacle_id, o_size, o_severity, dist = (a[within] for a in (i, obstacle_id, o_size, o_severity, dist))
+        # nearest candidate last so it wins the assignment
+        order = np.argsort(-dist)
+        ids[i[order]] = obstacle_id[order]
+        sizes[i[order]] = o_size[order]
+        severities[i[order]] = o_severity[order]
+        return ids, sizes, severities
+
+    def _cluster(self, lats, lons, sizes):
+        """Groups detections of one batch that are within `distance` of each other.
+
+        Detections are visited from the largest, each joins the nearest group representative
+        within `distance` or starts a new group. A grid of cells at least `distance` wide
+        limits the comparisons to the neighbouring cells.
+
+        Returns:
+            np.ndarray: Index of the representative detection of every detection
+        """
+        cell_lat = self.distance / METERS_PER_DEGREE
+        cell_lon = cell_lat / max(np.cos(np.radians(np.abs(lats).max())), 1e-6)
+        rows, cols = np.floor(lats / cell_lat).astype(np.int64), np.floor(lons / cell_lon).astype(np.int64)
+
+        rep = np.arange(len(lats))
+        cells = {}
+        for i in np.argsort(-sizes, kind='stable'):
+            row, col = int(rows[i]), int(cols[i])
+            candidates = [
+                j for dr in (-1, 0, 1) for dc in (-1, 0, 1)
+                for j in cells.get((row + dr, col + dc), ())
+            ]
+            if candidates:
+                dist = haversine(lats[i], lons[i], lats[candidates], lons[candidates])
+                if dist.min() <= self.distance:
+                    rep[i] = candidates[int(dist.argmin())]
+                    continue
+            cells.setdefault((row, col), []).append(i)
+        return rep
+
+    def upsert(self, records, now=None):
+        """Matches detections against the stored obstacles and saves them in one transaction.
+        Detections of the same obstacle within the batch, e.g. from overlapping scenes, are
+        merged first, only the largest of them is matched and stored.
+
+        Args:
+            records (list): Obstacle records, see `ObstacleExtractor.add_tile`
+            now (float): Detection time as a UNIX timestamp, defaults to the current time
+
+        Returns:
+            tuple: Arrays of obstacle ids, status per record ('new', 'worse', 'seen' or 'duplicate'
+                for the other detections of an obstacle in the same batch) and the stored severity
+                level of the obstacle (-1 if it has not been scored yet)
+        """
+        now = time.time() if now is None else now
+        if not records:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=object), np.zeros(0, dtype=np.int64)
+        lats = np.array([record['location'][0] for record in records], dtype=float)
+        lons = np.array([record['location'][1] for record in records], dtype=float)
+        sizes = np.array([record['size'] for record in records], dtype=float)
+        areas = np.array([float(record.get('area', 0)) for record in records])
+
+        # only the representative detection of each in-batch group is matched and stored
+        rep = self._cluster(lats, lons, sizes)
+        reps, group = np.unique(rep, return_inverse=True)
+        duplicate = rep != np.arange(len(records))
+        lats, lons, sizes, areas = lats[reps], lons[reps], sizes[reps], areas[reps]
+
+        with self.lock, self.conn:
+            ids, old_sizes, severities = self._match(lats, lons, now - self.max_age)
+            matched = ids >= 0
+            status = np.where(matched, 'seen', 'new').astype(object)
+            # obstacles that grew or were never scored go through scoring again
+            status[matched & ((sizes > old_sizes * (1 + self.growth)) | (severities < 0))] = 'worse'
+
+            self.conn.executemany(
+                'UPDATE obstacles SET lat = ?, lon = ?, size = MAX(size, ?), area = ?, last_seen = ?, '
+                'detections = detections + 1 WHERE id = ?',
+                [(lats[i], lons[i], sizes[i], areas[i], now, int(ids[i])) for i in np.flatnonzero(matched)]
+            )
+            self.conn.executemany(
+                'UPDATE obstacles_rtree SET min_lat = ?, max_lat = ?, min_lon = ?, max_lon = ? WHERE id = ?',
+                [(lats[i], lats[i], lons[i], lons[i], int(ids[i])) for i in np.flatnonzero(matched)]
+            )
+
+            new = np.flatnonzero(~matched)
+            if len(new):
+                start = self.conn.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM obstacles').fetchone()[0]
+                ids[new] = np.arange(start, start + len(new))
+                self.conn.executemany(
+                    'INSERT INTO obstacles (id, lat, lon, size, area, first_seen, last_seen) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(int(ids[i]), lats[i], lons[i], sizes[i], areas[i], now, now) for i in new]
+                )
+                self.conn.executemany(
+                    'INSERT INTO obstacles_rtree VALUES (?, ?, ?, ?, ?)',
+                    [(int(ids[i]), lats[i], lats[i], lons[i], lons[i]) for i in new]
+                )
+
+        ids, status, severities = ids[group], status[group], severities[group]
+        status[duplicate] = 'duplicate'
+        return ids, status, severities
+
+    def set_severity(self, ids, levels):
+        """Stores the severity levels of scored obstacles."""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'UPDATE obstacles SET severity = ? WHERE id = ?',
+                zip(map(int, levels), map(int, ids))
+            )
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,198 @@
+import json
+
+import cv2
+import numpy as np
+from pyproj import CRS, Transformer
+
+
+class ObstacleExtractor:
+    """
+    Streaming connected-component labelling of a debris probability map.
+
+    Tiles are thresholded and labelled one by one, components that cross tile
+    borders are merged with a union-find over global labels. Only the labels on
+    the bottom border of the previous tile row are kept, so a full-scene array
+    is never needed. Components are emitted as soon as no later tile can touch them.
+
+    Tiles must be added in row-major order, tiles that are never added count as background.
+
+    Args:
+        transform (affine.Affine): pixel to CRS transform of the scene
+        crs: CRS of the scene, None if the scene is not georeferenced
+        shape (tuple[int, int]): scene height and width
+        threshold (float): debris probability threshold
+        min_pixels (int): smaller components are discarded as noise
+    """
+
+    def __init__(self, transform, crs, shape, threshold=0.5, min_pixels=1):
+        self.transform = transform
+        self.to_latlon = Transformer.from_crs(crs, "EPSG:4326", always_xy=True) if crs else None
+        # sizes are reported in metres so they are comparable between geographic and projected scenes
+        crs = CRS.from_user_input(crs) if crs else None
+        self.geod = crs.get_geod() if crs is not None and crs.is_geographic else None
+        self.unit = crs.axis_info[0].unit_conversion_factor if crs is not None and not crs.is_geographic else 1.0
+        self.height, self.width = shape
+        self.threshold = threshold
+        self.min_pixels = min_pixels
+
+        self.next_id = 1
+        self.parent = {}
+        # per root: [area, sum_row, sum_col, min_row, min_col, max_row, max_col]
+        self.stats = {}
+
+        # global labels of the last row of the previous and current tile row
+        self.prev_bottom = np.zeros(self.width, dtype=np.int64)
+        self.cur_bottom = np.zeros(self.width, dtype=np.int64)
+        self.row_off, self.row_end = None, None
+        # (col_end, labels) of the right column of the previous tile in the current tile row
+        self.left = None
+
+    def find(self, label):
+        root = label
+        while self.parent[root] != root:
+            root = self.parent[root]
+        # path compression
+        while self.parent[label] != root:
+            self.parent[label], label = root, self.parent[label]
+        return root
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return
+        a_stats, b_stats = self.stats[a], self.stats.pop(b)
+        self.stats[a] = [
+            a_stats[0] + b_stats[0], a_stats[1] + b_stats[1], a_stats[2] + b_stats[2],
+            min(a_stats[3], b_stats[3]), min(a_stats[4], b_stats[4]),
+            max(a_stats[5], b_stats[5]), max(a_stats[6], b_stats[6]),
+        ]
+        self.parent[b] = a
+
+    def _union_pairs(self, a, b):
+        # union all pairs of labels where both sides are foreground
+        pairs = np.stack([a, b], axis=1)[(a > 0) & (b > 0)]
+        for x, y in np.unique(pairs, axis=0):
+            self.union(int(x), int(y))
+
+    def _next_row(self, row_off):
+        """Moves to a new tile row and emits the components of the finished one."""
+        records = []
+        if self.row_off is not None:
+            records = self._emit_finished(self.cur_bottom)
+        contiguous = self.row_end is not None and row_off == self.row_end
+        self.prev_bottom = self.cur_bottom if contiguous else np.zeros(self.width, dtype=np.int64)
+        self.cur_bottom = np.zeros(self.width, dtype=np.int64)
+        self.row_off = row_off
+        self.left = None
+        return records
+
+    def _emit_finished(self, frontier):
+        # components that are not on the frontier can no longer grow
+        labels, inverse = np.unique(frontier, return_inverse=True)
+        roots = np.array([self.find(int(l)) if l else 0 for l in labels], dtype=np.int64)
+        frontier[:] = roots[inverse]
+        active = set(roots.tolist()) - {0}
+
+        records = [
+            self._record(self.stats.pop(root))
+            for root in list(self.stats) if root not in active
+        ]
+        # only the active roots can still be referenced
+        self.parent = {root: root for root in active}
+        return [r for r in records if r is not None]
+
+    def _record(self, stats):
+        area, sum_row, sum_col, min_row, min_col, max_row, max_col = stats
+        if area < self.min_pixels:
+            return None
+        # centroid at pixel centers
+        x, y = self.transform * (sum_col / area + 0.5, sum_row / area + 0.5)
+        lon, lat = self.to_latlon.transform(x, y) if self.to_latlon else (x, y)
+        pixel_w, pixel_h = abs(self.transform.a), abs(self.transform.e)
+        if self.geod is not None:
+            # pixel size in degrees to metres at the centroid
+            pixel_w = self.geod.inv(x, y, x + pixel_w, y)[2]
+            pixel_h = self.geod.inv(x, y, x, y + pixel_h)[2]
+        else:
+            pixel_w, pixel_h = pixel_w * self.unit, pixel_h * self.unit
+        return {
+            'location': (float(lat), float(lon)),
+            'size': float(max((max_col - min_col + 1) * pixel_w, (max_row - min_row + 1) * pixel_h)),
+            'area': float(area * pixel_w * pixel_h),
+            'pixels': int(area),
+        }
+
+    def add_tile(self, tile, row_off, col_off):
+        """
+        Labels a tile of the probability map.
+
+        Args:
+            tile (np.ndarray): debris probability of shape [h, w] or [1, h, w], cropped to the scene
+            row_off (int): row of the top left pixel in the scene
+            col_off (int): column of the top left pixel in the scene
+
+        Returns:
+            list: obstacle records that were finished by moving to a new tile row:
+                - location (tuple(float, float)): Latitude and longitude of the centroid
+                - size (float): Longer side of the bounding box in metres
+                - area (float): Area in square metres
+                - pixels (int): Number of pixels
+        """
+        records = []
+        if row_off != self.row_off:
+            records = self._next_row(row_off)
+
+        tile = np.asarray(tile).reshape(np.shape(tile)[-2:])
+        h, w = tile.shape
+        self.row_end = row_off + h
+
+        binary = (tile >= self.threshold).astype(np.uint8)
+        n, labels, stats, centroids = cv2.connectedComponentsWithStats(binary, connectivity=8, ltype=cv2.CV_32S)
+
+        # local labels 1..n-1 to new global labels
+        global_ids = np.zeros(n, dtype=np.int64)
+        global_ids[1:] = np.arange(self.next_id, self.next_id + n - 1)
+        self.next_id += n - 1
+        for k in range(1, n):
+            area = int(stats[k, cv2.CC_STAT_AREA])
+            left, top = int(stats[k, cv2.CC_STAT_LEFT]), int(stats[k, cv2.CC_STAT_TOP])
+            self.parent[int(global_ids[k])] = int(global_ids[k])
+            self.stats[int(global_ids[k])] = [
+                area, (centroids[k, 1] + row_off) * area, (centroids[k, 0] + col_off) * area,
+                row_off + top, col_off + left,
+                row_off + top + int(stats[k, cv2.CC_STAT_HEIGHT]) - 1,
+                col_off + left + int(stats[k, cv2.CC_STAT_WIDTH]) - 1,
+            ]
+        labels = global_ids[labels]
+
+        # merge with the bottom row of the tile row above, including diagonals
+        above = np.zeros(w + 2, dtype=np.int64)
+        lo, hi = max(col_off - 1, 0), min(col_off + w + 1, self.width)
+        above[lo - (col_off - 1):hi - (col_off - 1)] = self.prev_bottom[lo:hi]
+        for d in (0, 1, 2):
+            self._union_pairs(above[d:d + w], labels[0])
+
+        # merge with the right column of the tile on the left, including diagonals
+        if self.left is not None and self.left[0] == col_off:
+            left = np.pad(self.left[1], 1)
+            for d in (0, 1, 2):
+                self._union_pairs(left[d:d + h], labels[:, 0])
+
+        self.cur_bottom[col_off:col_off + w] = labels[-1]
+        self.left = (col_off + w, labels[:, -1])
+        return records
+
+    def finish(self):
+        """Emits all remaining obstacle records."""
+        records = [self._record(stats) for stats in self.stats.values()]
+        self.stats, self.parent = {}, {}
+        return [r for r in records if r is not None]
+
+
+def read_obstacles(path):
+    """Reads obstacle records written as JSON lines by predict.py."""
+    with open(path) as f:
+        for line in f:
+            obstacle = json.loads(line)
+            obstacle['location'] = tuple(obstacle['location'])
+            yield obstacle
@@ -1,12 +1,287 @@
+import json
+import math
+import os
 from argparse import ArgumentParser
+from contextlib import ExitStack, nullcontext
+from itertools import islice
 from pathlib import Path
 
-import lightning as L
+import numpy as np
+import rasterio
+import rasterio.shutil
 import torch
+from torch.nn import functional as F
 from torch.utils.data import DataLoader
 
-from models import RiverDebrisModel
 from data.dataset import RiverDebrisPredDataset
+from data.raster import RasterTileReader
+from inference import CPUModel, load_model, set_threads
+from obstacles import ObstacleExtractor
+
+
+def batched(iterable, n):
+    """Split iterable into lists of at most n elements."""
+    it = iter(iterable)
+    while batch := list(islice(it, n)):
+        yield batch
+
+
+def calibration_tiles(img_path, mask_path, tile_size, num_tiles, batch_size=16):
+    """
+    Collect river tiles of a scene for int8 calibration.
+
+    Returns:
+        list of image tile batches of shape [B, C, t_h, t_w]
+    """
+    tiles = []
+    with RasterTileReader(img_path, mask_path, tile_size) as reader:
+        for window in reader.windows():
+            if reader.read_mask(window).any():
+                tiles.append(torch.from_numpy(reader.read_image(window)))
+            if len(tiles) == num_tiles:
+                break
+    return [torch.stack(batch) for batch in batched(tiles, batch_size)]
+
+
+def find_scenes(img_root, mask_root=None):
+    """
+    List the images to predict with their river masks, images without a mask are left out.
+
+    Returns:
+        sorted list of (image path, mask path or None)
+    """
+    scenes = []
+    for img_path in sorted(img_root.glob("*.tif")):
+        mask_path = mask_root / f"{img_path.stem}.png" if mask_root else None
+        if mask_path is None or mask_path.exists():
+            scenes.append((img_path, mask_path))
+    return scenes
+
+
+def load_predictor(checkpoint_path, precision=None, calibration_scene=None, tile_size=(256, 256), num_calibration_tiles=64,
+                   gate_threshold=None):
+    """
+    Load the model used by `predict_scene`.
+
+    Args:
+        checkpoint_path (Path): checkpoint or exported model
+        precision (str): (optional) "fp32", "bf16" or "int8" CPU optimized inference, see `CPUModel`
+        calibration_scene (tuple): (image path, mask path) whose river tiles calibrate int8
+        tile_size (tuple[int, int]): size of the calibration tiles
+        num_calibration_tiles (int): number of calibration tiles
+        gate_threshold (float): (optional) only decode tiles the tile classifier flags with at
+            least this debris probability, needs a checkpoint trained with `cls_head`
+
+    Returns:
+        model with a `predict_tiles` method
+    """
+    device = "cuda" if precision is None and torch.cuda.is_available() else "cpu"
+    model = load_model(checkpoint_path, device)
+    if gate_threshold is not None:
+        assert getattr(getattr(model, "model", None), "cls", None) is not None, \
+            f"{checkpoint_path} has no tile classifier to gate with"
+    if precision is None:
+        if gate_threshold is not None:
+            model.gate_threshold = gate_threshold
+        return model
+    calibration = None
+    if precision == "int8" and calibration_scene is not None:
+        calibration = calibration_tiles(*calibration_scene, tile_size, num_calibration_tiles)
+    return CPUModel(model, precision, calibration=calibration, gate_threshold=gate_threshold)
+
+
+class CoarseMap:
+    """
+    Debris probability of a scene downsampled by `scale`, predicted one band of
+    coarse tiles at a time. Only the bands covering the rows asked for last are
+    kept, so memory does not grow with the scene height as long as rows are
+    requested top to bottom.
+
+    Args:
+        model: model with a `predict_tiles` method
+        reader (RasterTileReader): reader of the scene
+        scale (int): downsampling factor
+        batch_size (int): number of tiles in a forward pass
+        min_river_coverage (float): minimum ratio of river pixels in a predicted tile
+    """
+
+    def __init__(self, model, reader, scale, batch_size=16, min_river_coverage=0.0):
+        self.model = model
+        self.reader = reader
+        self.scale = scale
+        self.batch_size = batch_size
+        self.min_river_coverage = min_river_coverage
+        t_h, t_w = reader.tile_size
+        # coarse tiles per band, covering the full resolution windows past the right edge
+        self.cols = math.ceil(reader.shape[1] / (t_w * scale))
+        self.bands = {}
+
+    def _predict_band(self, band):
+        t_h, t_w = self.reader.tile_size
+        window = rasterio.windows.Window(
+            0, band * t_h * self.scale, self.cols * t_w * self.scale, t_h * self.scale
+        )
+        image, river_mask = self.reader.read_overview(window, self.scale)
+        # [C, t_h, cols * t_w] -> [cols, C, t_h, t_w]
+        img_tiles = torch.from_numpy(image.reshape(-1, t_h, self.cols, t_w).transpose(2, 0, 1, 3).copy())
+        river_mask_tiles = torch.from_numpy(river_mask.reshape(1, t_h, self.cols, t_w).transpose(2, 0, 1, 3).copy())
+
+        pred = torch.zeros_like(river_mask_tiles)
+        keep = (river_mask_tiles.flatten(1).mean(1) > self.min_river_coverage).nonzero()[:, 0]
+        # coarse tiles stay out of the tile counters of RiverDebrisModel
+        untracked = getattr(self.model, "untracked", nullcontext)
+        with untracked():
+            for idx in batched(keep.tolist(), self.batch_size):
+                pred[idx] = self.model.predict_tiles(
+                    img_tiles[idx].to(self.model.device), river_mask_tiles[idx].to(self.model.device)
+                ).float().cpu()
+        return pred[:, 0].permute(1, 0, 2).reshape(t_h, self.cols * t_w).numpy()
+
+    def rows(self, start, stop):
+        """
+        Coarse rows [start, stop), bands above `start` are dropped.
+
+        Returns:
+            float32 array [stop - start, w]
+        """
+        t_h = self.reader.tile_size[0]
+        first, last = start // t_h, (stop - 1) // t_h
+        self.bands = {band: rows for band, rows in self.bands.items() if band >= first}
+        for band in range(first, last + 1):
+            if band not in self.bands:
+                self.bands[band] = self._predict_band(band)
+        rows = np.concatenate([self.bands[band] for band in range(first, last + 1)])
+        return rows[start - first * t_h:stop - first * t_h]
+
+
+def coarse_window(coarse, window, scale):
+    """
+    Upsample the part of the coarse prediction covering a full resolution window.
+
+    Args:
+        coarse (CoarseMap): coarse prediction of the scene
+        window (rasterio.windows.Window): full resolution window
+        scale (int): downsampling factor of the coarse prediction
+
+    Returns:
+        float32 tensor [1, t_h, t_w]
+    """
+    row, col = int(window.row_off), int(window.col_off)
+    t_h, t_w = int(window.height), int(window.width)
+    r0, c0 = row // scale, col // scale
+    r1, c1 = math.ceil((row + t_h) / scale), math.ceil((col + t_w) / scale)
+    region = torch.from_numpy(np.ascontiguousarray(coarse.rows(r0, r1)[:, c0:c1]))[None, None]
+    up = F.interpolate(region, scale_factor=scale, mode="bilinear", align_corners=False)
+    return up[0, :, row - r0 * scale:row - r0 * scale + t_h, col - c0 * scale:col - c0 * scale + t_w]
+
+
+@torch.inference_mode()
+def predict_scene(model, img_path, mask_path, out_path, tile_size=(256, 256), batch_size=16,
+                  cog=False, min_river_coverage=0.0, obstacle_threshold=None, min_obstacle_pixels=1,
+                  coarse_scale=None, coarse_threshold=0.2):
+    """
+    Predict debris probability for a whole scene window by window at native resolution.
+    Only `batch_size` tiles are held in memory at a time and every batch is written
+    to the output GeoTIFF as soon as it is predicted.
+
+    The river mask is read first and works as a spatial index, tiles whose river
+    coverage is at or below `min_river_coverage` are never read nor passed through
+    the model and stay zero in the output.
+
+    With `coarse_scale` every tile row is first predicted downsampled by that
+    factor, band by band so memory stays flat (see `CoarseMap`). Only windows
+    where the coarse debris probability reaches `coarse_threshold` are predicted
+    again at full resolution, the others get the upsampled coarse prediction.
+
+    Args:
+        model: RiverDebrisModel in eval mode, ExportedModel or CPUModel
+        img_path (Path): path to the image
+        mask_path (Path): path to the river mask, None to predict everywhere
+        out_path (Path): path of the output GeoTIFF
+        tile_size (tuple[int, int]): size of the tiles fed to the model
+        batch_size (int): number of tiles in a forward pass
+        cog (bool): convert the output into a cloud optimized GeoTIFF
+        min_river_coverage (float): minimum ratio of river pixels in a predicted tile
+        obstacle_threshold (float): (optional) debris probability threshold, if given obstacles
+            are extracted tile by tile and streamed as JSON lines next to the output
+        min_obstacle_pixels (int): smaller obstacles are discarded as noise
+        coarse_scale (int): (optional) downsampling factor of the coarse pass, at least 1
+        coarse_threshold (float): coarse debris probability from which a window is refined
+
+    Returns:
+        dict: tile counts `total`, `skipped` and `coarse` (not refined) and number of `obstacles`
+    """
+    assert coarse_scale is None or coarse_scale >= 1, f"coarse_scale must be at least 1, got {coarse_scale}"
+    device = model.device
+    if hasattr(model, "reset_stats"):
+        # the tile counters of RiverDebrisModel cover this scene only
+        model.reset_stats()
+    tmp_path = out_path.with_suffix(".tmp.tif") if cog else out_path
+    stats = {"total": 0, "skipped": 0, "coarse": 0, "obstacles": 0}
+    coarse = None
+
+    def river_tiles(reader):
+        for window in reader.windows():
+            river_mask = reader.read_mask(window)
+            stats["total"] += 1
+            if river_mask.mean() <= min_river_coverage:
+                stats["skipped"] += 1
+                continue
+            if coarse is not None:
+                coarse_tile = coarse_window(coarse, window, coarse_scale) * torch.from_numpy(river_mask)
+                if coarse_tile.max() < coarse_threshold:
+                    stats["coarse"] += 1
+                    yield window, river_mask, coarse_tile.numpy()
+                    continue
+            yield window, river_mask, None
+
+    # skipped tiles are never written, GeoTIFF blocks that are not written read as zero
+    with RasterTileReader(img_path, mask_path, tile_size) as reader, \
+            rasterio.open(tmp_path, "w", **reader.output_profile()) as dst, \
+            ExitStack() as stack:
+        height, width = reader.shape
+        if coarse_scale is not None:
+            coarse = CoarseMap(model, reader, coarse_scale, batch_size, min_river_coverage)
+
+        extractor = None
+        if obstacle_threshold is not None:
+            extractor = ObstacleExtractor(
+                reader.img.transform, reader.img.crs, reader.shape,
+                obstacle_threshold, min_obstacle_pixels
+            )
+            obstacles_file = stack.enter_context(open(out_path.with_suffix(".obstacles.jsonl"), "w"))
+
+        def write_obstacles(records):
+            for record in records:
+                obstacles_file.write(json.dumps(record) + "\n")
+            stats["obstacles"] += len(records)
+
+        for batch in batched(river_tiles(reader), batch_size):
+            windows, river_mask, pred = map(list, zip(*batch))
+            # windows the coarse pass ruled out keep its upsampled prediction
+            refine = [i for i, tile in enumerate(pred) if tile is None]
+            if refine:
+                x = torch.from_numpy(np.stack([reader.read_image(windows[i]) for i in refine])).to(device)
+                refine_mask = torch.from_numpy(np.stack([river_mask[i] for i in refine])).to(device)
+                for i, tile in zip(refine, model.predict_tiles(x, refine_mask).cpu().numpy()):
+                    pred[i] = tile
+
+            for window, tile in zip(windows, pred):
+                # crop the padding of edge tiles
+                w = window.intersection(rasterio.windows.Window(0, 0, width, height))
+                tile = tile[:, :int(w.height), :int(w.width)]
+                dst.write(tile, window=w)
+                if extractor is not None:
+                    write_obstacles(extractor.add_tile(tile, int(w.row_off), int(w.col_off)))
+
+        if extractor is not None:
+            write_obstacles(extractor.finish())
+
+    if cog:
+        rasterio.shutil.copy(tmp_path, out_path, driver="COG", compress="deflate")
+        os.remove(tmp_path)
+    return stats
+
 
 if __name__ == "__main__":
     parser = ArgumentParser("seg")
@@ -14,18 +289,122 @@ if __name__ == "__main__":
         "--img_root", type=Path, help="Path to dir containing images."
     )
     parser.add_argument(
-        "--checkpoint_path", type=Path, help="Path to checkpoint."
+        "--checkpoint_path", type=Path,
+        help="Path to checkpoint, or to a model exported by export_model.py in streaming mode."
     )
     parser.add_argument(
         "--mask_root", type=Path, help="Path to dir containing masks."
     )
+    parser.add_argument(
+        "--out_root", type=Path, default=Path("out"),
+        help="Path to output dir."
+    )
+    parser.add_argument(
+        "--stream", action="store_true",
+        help="Predict window by window at native resolution into GeoTIFFs."
+    )
+    parser.add_argument(
+        "--tile_size", type=int, default=256,
+        help="Tile size used in streaming mode."
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=16,
+        help="Tiles per forward pass in streaming mode."
+    )
+    parser.add_argument(
+        "--stride", type=int, default=None,
+        help="Tile stride, smaller than 256 for overlapping blended tiles (non-streaming mode)."
+    )
+    parser.add_argument(
+        "--min_river_coverage", type=float, default=0.0,
+        help="Tiles with river coverage at or below this ratio are skipped."
+    )
+    parser.add_argument(
+        "--obstacle_threshold", type=float, default=None,
+        help="Extract obstacles above this debris probability in streaming mode."
+    )
+    parser.add_argument(
+        "--min_obstacle_pixels", type=int, default=16,
+        help="Obstacles with fewer pixels are discarded."
+    )
+    parser.add_argument(
+        "--precision", choices=["fp32", "bf16", "int8"], default=None,
+        help="Run CPU optimized inference in this precision in streaming mode."
+    )
+    parser.add_argument(
+        "--coarse_scale", type=int, default=None,
+        help="Predict the scene downsampled by this factor first and refine only likely debris in streaming mode."
+    )
+    parser.add_argument(
+        "--coarse_threshold", type=float, default=0.2,
+        help="Coarse debris probability from which a window is refined at full resolution."
+    )
+    parser.add_argument(
+        "--gate_threshold", type=float, default=None,
+        help="Only decode tiles the tile classifier flags with at least this debris probability."
+    )
+    parser.add_argument(
+        "--calibration_tiles", type=int, default=64,
+        help="River tiles of the first image used to calibrate int8 quantization."
+    )
+    parser.add_argument(
+        "--intra_op_threads", type=int, default=None,
+        help="Threads used inside an operator."
+    )
+    parser.add_argument(
+        "--inter_op_threads", type=int, default=None,
+        help="Threads used to run independent operators."
+    )
+    parser.add_argument(
+        "--cog", action="store_true",
+        help="Write cloud optimized GeoTIFFs in streaming mode."
+    )
     args = parser.parse_args()
+    if args.coarse_scale is not None and args.coarse_scale < 1:
+        parser.error("--coarse_scale must be at least 1")
+
+    os.makedirs(args.out_root, exist_ok=True)
+    set_threads(args.intra_op_threads, args.inter_op_threads)
+
+    if args.stream:
+        scenes = find_scenes(args.img_root, args.mask_root)
+        model = load_predictor(
+            args.checkpoint_path, args.precision, scenes[0] if scenes else None,
+            (args.tile_size, args.tile_size), args.calibration_tiles, args.gate_threshold
+        )
+
+        total, skipped = 0, 0
+        for img_path, mask_path in scenes:
+            print(f"predicting {img_path}...")
+            stats = predict_scene(
+                model, img_path, mask_path, args.out_root / f"{img_path.stem}.tif",
+                (args.tile_size, args.tile_size), args.batch_size, args.cog,
+                args.min_river_coverage, args.obstacle_threshold, args.min_obstacle_pixels,
+                args.coarse_scale, args.coarse_threshold
+            )
+            total, skipped = total + stats["total"], skipped + stats["skipped"]
+            print(f"skipped {stats['skipped']}/{stats['total']} tiles without river.")
+            if args.coarse_scale is not None:
+                print(f"kept the coarse prediction of {stats['coarse']}/{stats['total'] - stats['skipped']} river tiles.")
+        print(f"skip ratio: {skipped / max(total, 1):.3f}")
+    else:
+        # only import Lightning when it is actually needed
+        import lightning as L
+        from models import RiverDebrisModel
+
+        model = RiverDebrisModel.load_from_checkpoint(args.checkpoint_path)
+        model.min_river_coverage = args.min_river_coverage
+        model.gate_threshold = args.gate_threshold
+        dataset = RiverDebrisPredDataset(
+            args.img_root, args.mask_root, (2048, 2048), (256, 256),
+            (args.stride, args.stride) if args.stride else None
+        )
+        dataloader = DataLoader(dataset, 1)
+        trainer = L.Trainer()
+        model.reset_stats()
 
-    model = RiverDebrisModel.load_from_checkpoint(args.checkpoint_path)
-    dataset = RiverDebrisPredDataset(args.img_root, args.mask_root, (2048, 2048), (256, 256))
-    dataloader = DataLoader(dataset, 1)
-    trainer = L.Trainer()
-    
-    preds = trainer.predict(model, dataloader)
-    seg = dataset.tiler.untile(preds[0])
-    torch.save(seg, "out.pt")
\ No newline at end of file
+        preds = trainer.predict(model, dataloader)
+        for img_path, pred in zip(dataset.image_paths, preds):
+            seg = dataset.tiler.untile(pred)
+            torch.save(seg, args.out_root / f"{img_path.stem}.pt")
+        print(f"skip ratio: {model.skip_ratio:.3f}")
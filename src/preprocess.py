@@ -0,0 +1,30 @@
+from argparse import ArgumentParser
+from pathlib import Path
+
+from data.tile_cache import build_tile_cache
+
+if __name__ == "__main__":
+    parser = ArgumentParser("Tile cache")
+    parser.add_argument(
+        "--img_root", type=Path, help="Path to dir containing images."
+    )
+    parser.add_argument(
+        "--mask_root", type=Path, help="Path to dir containing masks."
+    )
+    parser.add_argument(
+        "--cache_root", type=Path, help="Path to output dir."
+    )
+    parser.add_argument(
+        "--img_size", type=int, default=2048,
+        help="Size the images are resized to."
+    )
+    parser.add_argument(
+        "--tile_size", type=int, default=256,
+        help="Tile size."
+    )
+    args = parser.parse_args()
+
+    build_tile_cache(
+        args.img_root, args.mask_root, args.cache_root,
+        (args.img_size, args.img_size), (args.tile_size, args.tile_size)
+    )
@@ -1,100 +1,99 @@
+import asyncio
+import json
+import threading
+import time
 from base64 import b64decode
 from multiprocessing import Process
 
 import cv2
 import discord
-import geopandas as gpd
 import numpy as np
-import openmeteo_requests
 import pandas as pd
-import requests_cache
 import torch
 from discord import app_commands
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from notifier import ObstacleNotifier
-from retry_requests import retry
+from obstacles import ObstacleExtractor
+from rasterio.transform import from_bounds
 from secret import TOKEN
-from models import RiverDebrisModel
-from data.dataset import RiverDebrisPredDataset
-from torch.utils.data import DataLoader
-import lightning as L
-from PIL import Image
-import torchvision
+from severity import SEVERITY_NAMES, is_weather_dangerous, score_severity
+from endangered import EndangeredAreas
+from weather import WeatherCache
+from model_server import ModelServer
+from jobs import JobQueue, QueueFull, stage
+from snapshot import Snapshot
+from alerts import AlertChannel
+from obstacle_store import ObstacleStore
+from data.tiler import Tiler
 
 
 CHANNEL_ID = 1046387247336923176
+CHECKPOINT_PATH = 'models/last.ckpt'
+TILE_SIZE = (256, 256)
+JOB_TIMEOUT = 300
+# weather stations are cached for an hour, refreshing more often only re-fetches the expired ones
+WEATHER_REFRESH_INTERVAL = 600
+OBSTACLE_STORE_PATH = 'obstacles.sqlite'
 
 
 intents = discord.Intents.default()
 
 
 client = ObstacleNotifier(intents=intents)
+weather_cache = WeatherCache()
+endangered_areas = EndangeredAreas('endangered_areas')
+coordinates = None
+# created in __main__ and shared by the Discord and Flask processes
+alert_channel = None
+obstacle_store = None
+obstacle_store_lock = threading.Lock()
+
+
+def get_obstacle_store():
+    """Returns the obstacle store of this process, opening it on first use."""
+    global obstacle_store
+    with obstacle_store_lock:
+        if obstacle_store is None:
+            obstacle_store = ObstacleStore(OBSTACLE_STORE_PATH)
+    return obstacle_store
 
 
 async def run_weather(latitudes: list, longitudes: list):
-    """Calls the Open-Meteo API to get the weather data for the given coordinates.
+    """Gets the weather data for the given coordinates from the shared weather cache.
+    All coordinates missing from the cache are fetched with one batched request.
 
     Args:
         latitudes (list): List of latitudes (floats) to get the weather data for
         longitudes (list): List of longitudes (floats) to get the weather data for
     Returns:
-        list: List of weather data values:
-            - lat (float): Latitude of the measurement
-            - lon (float): Longitude of the measurement
-            - rain_ratio (float): Ratio of precipitation in next week to the precipitation in the last month
-            - flow_ratio (float): Ratio of water flow in next week to the water flow in the last month
+        list: List of weather data values, see `OpenMeteoClient.fetch`
     """
-    # Setup the Open-Meteo API client with cache and retry on error
-    cache_session = requests_cache.CachedSession('.cache', expire_after=3600)
-    retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
-    openmeteo = openmeteo_requests.Client(session=retry_session)
-
-    flow_url = "https://flood-api.open-meteo.com/v1/flood"
-    flow_params = {
-        "latitude": latitudes,
-        "longitude": longitudes,
-        "daily": "river_discharge",
-        "past_days": 31,
-        "forecast_days": 7
-    }
+    if not latitudes:
+        return []
+    return weather_cache.get(latitudes, longitudes)
 
-    rain_url = "https://api.open-meteo.com/v1/forecast"
-    rain_params = {
-        "latitude": latitudes,
-        "longitude": longitudes,
-        "daily": "precipitation_sum",
-        "past_days": 31,
-        "forecast_days": 7
-    }
 
-    flow_responses = openmeteo.weather_api(flow_url, params=flow_params)
-    rain_responses = openmeteo.weather_api(rain_url, params=rain_params)
-    results = []
-
-    for flow_response, rain_response in zip(flow_responses, rain_responses):
-        lat = rain_response.Latitude()
-        lon = rain_response.Longitude()
-        print(f"Coordinates {lat}°N {lon}°E")
-
-        flow_daily = flow_response.Daily()
-        daily_river_discharge = flow_daily.Variables(0).ValuesAsNumpy()
-        mean_flow_last_month = daily_river_discharge[:-7].mean()
-        mean_flow_next_week = daily_river_discharge[-7:].mean()
-        flow_ratio = np.round(mean_flow_next_week / mean_flow_last_month, 2)
-
-        rain_daily = rain_response.Daily()
-        daily_precipitation_sum = rain_daily.Variables(0).ValuesAsNumpy()
-        mean_rain_last_month = daily_precipitation_sum[:-7].mean()
-        mean_rain_next_week = daily_precipitation_sum[-7:].mean()
-        rain_ratio = np.round(mean_rain_next_week / mean_rain_last_month, 2)
-
-        results.append({
-            'lat': lat,
-            'lon': lon,
-            'rain_ratio': rain_ratio,
-            'flow_ratio': flow_ratio
-        })
-    return results
+async def evaluate_severities(latitudes, longitudes, sizes):
+    """Evaluates the severity of a batch of obstacles in one vectorized pass.
+
+    Args:
+        latitudes (array-like): Latitudes of the obstacles
+        longitudes (array-like): Longitudes of the obstacles
+        sizes (array-like): Sizes of the obstacles
+
+    Returns:
+        tuple: Tuple of (severities, weather_data) where severities is an array of
+            levels 1 (low), 2 (medium) or 3 (high) and weather_data the weather data per obstacle
+    """
+    latitudes, longitudes = list(latitudes), list(longitudes)
+    weather_data = await run_weather(latitudes, longitudes)
+    severities = score_severity(
+        sizes,
+        [weather['rain_ratio'] for weather in weather_data],
+        [weather['flow_ratio'] for weather in weather_data],
+        endangered_areas.contains(longitudes, latitudes)
+    )
+    return severities, weather_data
 
 
 async def evaluate_severity(lat, lon, size):
@@ -106,34 +105,10 @@ async def evaluate_severity(lat, lon, size):
         size (float): Size of the obstacle
 
     Returns:
-        str: Severity of the obstacle
+        int: Severity of the obstacle, 1 (low), 2 (medium) or 3 (high)
     """
-    score = 0
-    if size < 5:
-        score += 1
-    elif size < 10:
-        score += 3
-    else:
-        score += 5
-    # get weather data
-    weather_data = await run_weather([lat], [lon])
-    rain_ratio = weather_data[0]['rain_ratio']
-    flow_ratio = weather_data[0]['flow_ratio']
-    # read endangered locations
-    endangered_areas = gpd.read_file('endangered_areas')
-    is_endangered = endangered_areas.contains(
-        gpd.points_from_xy([lon], [lat])[0]).any()
-    if is_endangered:
-        score += 5
-    if rain_ratio > 1.5:
-        score += 3
-    if flow_ratio > 1.2:
-        score += 5
-    if score <= 4:
-        return 1
-    elif score <= 7:
-        return 2
-    return 3
+    severities, _ = await evaluate_severities([lat], [lon], [size])
+    return int(severities[0])
 
 
 async def run_preventive_weather_check():
@@ -142,17 +117,23 @@ async def run_preventive_weather_check():
     Returns:
         dict: Dictionary with the danger data in GeoJSON format
     """
-    coordinates = pd.read_csv('coordinates.csv')
+    global coordinates
+    if coordinates is None:
+        coordinates = pd.read_csv('coordinates.csv')
     river_names = coordinates['River'].tolist()
     latitudes = coordinates['Latitude'].tolist()
     longitudes = coordinates['Longitude'].tolist()
     weather_data = await run_weather(latitudes, longitudes)
+    dangerous = is_weather_dangerous(
+        [data['rain_ratio'] for data in weather_data],
+        [data['flow_ratio'] for data in weather_data]
+    )
     danger_data = {
         'type': 'FeatureCollection',
         'features': []
     }
-    for river_name, data in zip(river_names, weather_data):
-        if data['rain_ratio'] > 1.5 or data['flow_ratio'] > 1.2:
+    for river_name, data, is_dangerous in zip(river_names, weather_data, dangerous):
+        if is_dangerous:
             danger_data['features'].append({
                 'type': 'Feature',
                 'geometry': {
@@ -168,38 +149,52 @@ async def run_preventive_weather_check():
     return danger_data
 
 
-async def run_classifier():
-    """Runs the classifier to find obstacles, then check severity with weather data.
+async def run_classifier(classifier_data):
+    """Checks the severity of the obstacles found by the classifier with weather data.
+
+    Args:
+        classifier_data (iterable): Obstacle records, see `ObstacleExtractor.add_tile`
 
     Returns:
         dict: Dictionary with the classifier data in GeoJSON format
     """
-    classifier_data = [{
-        'location': (14.602211633, 46.149839240),
-        'size': 6.0,
-    }]
+    classifier_data = list(classifier_data)
     obstacles_data = {
         'type': 'FeatureCollection',
         'features': []
     }
-    for obstacle in classifier_data:
+    # obstacles reported by earlier runs keep their severity, only new or grown ones are scored and notified
+    store = get_obstacle_store()
+    ids, status, levels = store.upsert(classifier_data)
+    changed = np.flatnonzero(np.isin(status, ('new', 'worse')))
+    changed_data = [classifier_data[i] for i in changed]
+
+    # one batched weather lookup and vectorized scoring for all changed obstacles
+    severities, weather_data = await evaluate_severities(
+        [obstacle['location'][0] for obstacle in changed_data],
+        [obstacle['location'][1] for obstacle in changed_data],
+        [obstacle['size'] for obstacle in changed_data]
+    )
+    store.set_severity(ids[changed], severities)
+    levels[changed] = severities
+    # duplicate detections in this run share the severity of their obstacle
+    scored = dict(zip(ids[changed].tolist(), severities.tolist()))
+    levels = np.array([scored.get(int(i), level) for i, level in zip(ids, levels)], dtype=np.int64)
+
+    alerts = []
+    for obstacle, level, weather in zip(changed_data, severities, weather_data):
         lat, lon = obstacle['location']
-        size = obstacle['size']
-        severity = await evaluate_severity(lat, lon, size)
+        severity = SEVERITY_NAMES[int(level)]
         if severity in ('medium', 'high'):
-            weather_data = await run_weather([lat], [lon])
-            await client.notify_about_obstacle(
-                {
-                    'location': (lat, lon),
-                    'precipitation_ratio': weather_data[0]['rain_ratio'],
-                    'water_flow_ratio': weather_data[0]['flow_ratio']
-
-                },
-                client.get_channel(CHANNEL_ID),
-                mention_everyone=severity == 'high',
-                prefix=':warning: *High severity obstacle detected* :warning:\n'
-            )
+            alerts.append({
+                'location': (lat, lon),
+                'precipitation_ratio': float(weather['rain_ratio']),
+                'water_flow_ratio': float(weather['flow_ratio']),
+                'severity': severity
+            })
 
+    for obstacle, obstacle_id, obstacle_status, level in zip(classifier_data, ids, status, levels):
+        lat, lon = obstacle['location']
         obstacles_data['features'].append({
             'type': 'Feature',
             'geometry': {
@@ -207,9 +202,15 @@ async def run_classifier():
                 'coordinates': [lon, lat]
             },
             'properties': {
-                'severity': severity
+                'id': int(obstacle_id),
+                'status': obstacle_status,
+                'severity': int(level)
             }
         })
+
+    # the Discord client runs in its own process, hand the alerts over without waiting for it
+    if alerts and alert_channel is not None:
+        alert_channel.publish(alerts)
     return obstacles_data
 
 
@@ -226,47 +227,219 @@ async def command_error(interaction, error):
         await interaction.response.send_message(f'Error: {error}', ephemeral=True)
 
 
-def run_discord_bot():
+def run_discord_bot(alerts=None):
+    client.alerts = alerts
+    client.alert_channel_id = CHANNEL_ID
     client.run(TOKEN)
 
 
 app = Flask(__name__)
+model_server = None
+model_server_lock = threading.Lock()
 
 
-@app.route('/obstacles', methods=['GET', 'POST'])
-async def get_obstacles():
-    if request.method == 'GET':
-        return jsonify(await run_preventive_weather_check())
-    elif request.method == 'POST':
-        model = RiverDebrisModel.load_from_checkpoint('models/last.ckpt')
+def get_model_server():
+    """Returns the model server of this process, loading the model on first use."""
+    global model_server
+    with model_server_lock:
+        if model_server is None:
+            model_server = ModelServer(CHECKPOINT_PATH)
+    return model_server
+
 
-        return jsonify(await run_classifier())
-        photo = b64decode(request.get_json())
-        photo = cv2.imdecode(np.frombuffer(photo, np.uint8), cv2.IMREAD_COLOR)
-        photo = cv2.imread('./data/photos/photo.png')
-        photo = cv2.cvtColor(photo, cv2.COLOR_BGR2RGB)
-        photo = torch.tensor(photo).permute(2, 0, 1).unsqueeze(0).float() / 255
-        photo = torchvision.transforms.Resize((256, 256))(photo)
-        mask = cv2.imread('./data/masks/photo.png', cv2.IMREAD_GRAYSCALE)
-        mask = torch.tensor(mask).unsqueeze(0).unsqueeze(0).float() / 255
-        mask = 1 - mask
-        mask = torchvision.transforms.Resize((256, 256))(mask)
+def decode_image(data, flags=cv2.IMREAD_COLOR):
+    """Decodes a base64 encoded image."""
+    return cv2.imdecode(np.frombuffer(b64decode(data), np.uint8), flags)
 
-        with torch.no_grad():
-            pred = model.predict_step((photo, mask), 0)
-        
 
-        cv2.imshow('Segmentation', pred[0].squeeze().numpy())
-        cv2.waitKey(0)
-        return jsonify(await run_classifier(model, dataloader))
+def decode_photo(payload):
+    """Decodes the POSTed photo and optional river mask into model inputs.
 
+    Args:
+        payload (str | dict): Base64 encoded photo or dictionary with keys:
+            - photo (str): Base64 encoded photo
+            - mask (str): (optional) Base64 encoded river mask, black where river
+            - bounds (list): (optional) West, south, east and north longitude and latitude of the photo
 
-def run_flask_app():
-    app.run(port=5000)
+    Returns:
+        tuple: Tuple of photo [3, H, W] and river mask [1, H, W] tensors at the photo's resolution
+    """
+    if isinstance(payload, str):
+        payload = {'photo': payload}
+    photo = cv2.cvtColor(decode_image(payload['photo']), cv2.COLOR_BGR2RGB)
+    height, width = photo.shape[:2]
+    photo = torch.tensor(photo).permute(2, 0, 1).float() / 255
+    if 'mask' in payload:
+        mask = decode_image(payload['mask'], cv2.IMREAD_GRAYSCALE)
+        mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
+        mask = 1 - torch.tensor(mask).unsqueeze(0).float() / 255
+    else:
+        mask = torch.ones((1, height, width))
+    return photo, mask
+
+
+def run_prediction(payload, timings):
+    """Runs the full prediction pipeline on a POSTed photo: tiling, inference,
+    obstacle extraction and severity scoring.
+
+    Args:
+        payload (str | dict): See `decode_photo`
+        timings (dict): Filled with the duration of every stage in milliseconds
+
+    Returns:
+        dict: Dictionary with the classifier data in GeoJSON format
+    """
+    with stage(timings, 'decode'):
+        photo, mask = decode_photo(payload)
+        height, width = photo.shape[-2:]
+
+    with stage(timings, 'tiling'):
+        tiler = Tiler((height, width), TILE_SIZE)
+        img_tiles, mask_tiles = tiler.tile(photo), tiler.tile(mask)
+
+    with stage(timings, 'inference'):
+        # submit in chunks so one large photo does not make one huge forward pass
+        server = get_model_server()
+        futures = [
+            server.submit(x, m) for x, m in
+            zip(img_tiles.split(server.max_batch_size), mask_tiles.split(server.max_batch_size))
+        ]
+        results = [future.result() for future in futures]
+        pred = tiler.untile(torch.cat([pred for pred, _ in results]))
+        batch_sizes = [metrics['batch_size'] for _, metrics in results]
+
+    with stage(timings, 'obstacles'):
+        # obstacles can only be located if the photo bounds are known
+        classifier_data = []
+        if isinstance(payload, dict) and 'bounds' in payload:
+            extractor = ObstacleExtractor(
+                from_bounds(*payload['bounds'], width, height), 'EPSG:4326', (height, width)
+            )
+            classifier_data = extractor.add_tile(pred.numpy(), 0, 0) + extractor.finish()
+
+    with stage(timings, 'severity'):
+        obstacles_data = asyncio.run(run_classifier(classifier_data))
+
+    obstacles_data['metrics'] = {
+        'tiles': len(img_tiles),
+        'mean_batch_size': sum(batch_sizes) / len(batch_sizes),
+    }
+    return obstacles_data
+
+
+jobs = JobQueue(run_prediction, max_workers=2, max_queued=32)
+weather_snapshot = Snapshot(lambda: asyncio.run(run_preventive_weather_check()), WEATHER_REFRESH_INTERVAL)
+
+
+def snapshot_response(current):
+    """Serves a snapshot from memory, 304 when the client has it and gzipped when accepted."""
+    etag = current['etag']
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    elif 'gzip' in request.accept_encodings:
+        response = Response(current['gzip'], mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(current['body'], mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.last_modified = current['updated']
+    return response
+
+
+@app.route('/obstacles', methods=['GET', 'POST'])
+async def get_obstacles():
+    if request.method == 'GET':
+        # only the first request before the snapshot exists builds it, outside the event loop
+        return snapshot_response(await asyncio.to_thread(weather_snapshot.get))
+    elif request.method == 'POST':
+        # run through the job queue so synchronous clients share the concurrency limit
+        start = time.perf_counter()
+        try:
+            job_id = jobs.submit(request.get_json())
+        except QueueFull as e:
+            return jsonify({'error': str(e)}), 503
+        job = await asyncio.to_thread(jobs.get, job_id, JOB_TIMEOUT)
+        if job is None:
+            return jsonify({'id': job_id, 'error': 'job was evicted'}), 500
+        if job['status'] != 'done':
+            return jsonify({'id': job_id, 'status': job['status'], 'error': job['error']}), 500 if job['error'] else 504
+
+        # the stored result is shared with other readers of the job, only the copy gets the request metrics
+        obstacles_data = dict(job['result'], metrics=dict(
+            job['result']['metrics'], timings=job['timings'],
+            latency_ms=(time.perf_counter() - start) * 1000
+        ))
+        return jsonify(obstacles_data)
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Submits a photo for prediction and returns the job id immediately."""
+    try:
+        job_id = jobs.submit(request.get_json())
+    except QueueFull as e:
+        return jsonify({'error': str(e)}), 503
+    return jsonify({'id': job_id, 'status': 'queued'}), 202
+
+
+@app.route('/jobs/stats')
+def job_stats():
+    return jsonify(jobs.stats())
+
+
+@app.route('/alerts/stats')
+def alert_stats():
+    if alert_channel is None:
+        return jsonify({'error': 'alerts are not forwarded'}), 404
+    return jsonify(alert_channel.stats())
+
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    """Returns the job, ?wait=<seconds> long-polls until it finishes."""
+    job = jobs.get(job_id, min(request.args.get('wait', 0, type=float), JOB_TIMEOUT))
+    if job is None:
+        return jsonify({'error': 'unknown job'}), 404
+    return jsonify(job)
+
+
+@app.route('/jobs/<job_id>/stream')
+def stream_job(job_id):
+    """Streams the job status as server-sent events until the GeoJSON result is ready."""
+    if jobs.get(job_id) is None:
+        return jsonify({'error': 'unknown job'}), 404
+
+    def events():
+        status = None
+        while True:
+            job = jobs.get(job_id, wait=1)
+            if job is None:
+                # finished jobs are evicted after keep_finished seconds
+                yield f'event: evicted\ndata: {json.dumps({"id": job_id, "error": "job was evicted"})}\n\n'
+                return
+            if job['status'] != status or job['finished'] is not None:
+                status = job['status']
+                yield f'event: {status}\ndata: {json.dumps(job)}\n\n'
+            if job['finished'] is not None:
+                return
+
+    return Response(events(), mimetype='text/event-stream')
+
+
+def run_flask_app(alerts=None):
+    global alert_channel
+    alert_channel = alerts
+    # load the model and build the weather snapshot before serving so the first request does not pay for it
+    get_model_server()
+    weather_snapshot.get()
+    app.run(port=5000, threaded=True)
 
 
 if __name__ == '__main__':
-    discord_process = Process(target=run_discord_bot)
-    flask_process = Process(target=run_flask_app)
+    alerts = AlertChannel()
+    discord_process = Process(target=run_discord_bot, args=(alerts,))
+    flask_process = Process(target=run_flask_app, args=(alerts,))
     discord_process.start()
     flask_process.start()
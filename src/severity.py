@@ -0,0 +1,64 @@
+import numpy as np
+
+# threshold table shared by the obstacle scoring and the preventive weather check
+SEVERITY_TABLE = {
+    # size < 5 -> 1, size < 10 -> 3, else 5
+    'size': {'bins': [5, 10], 'scores': [1, 3, 5]},
+    'rain_ratio': {'threshold': 1.5, 'score': 3},
+    'flow_ratio': {'threshold': 1.2, 'score': 5},
+    'endangered': {'score': 5},
+    # score <= 4 -> 1 (low), score <= 7 -> 2 (medium), else 3 (high)
+    'levels': {'bins': [4, 7]},
+}
+SEVERITY_NAMES = {1: 'low', 2: 'medium', 3: 'high'}
+
+
+def is_weather_dangerous(rain_ratios, flow_ratios):
+    """Checks which locations expect dangerous rain or water flow.
+
+    Args:
+        rain_ratios (array-like): Ratios of precipitation in next week to the precipitation in the last month
+        flow_ratios (array-like): Ratios of water flow in next week to the water flow in the last month
+
+    Returns:
+        np.ndarray: Boolean array, True where either ratio exceeds its threshold
+    """
+    return (
+        (np.asarray(rain_ratios) > SEVERITY_TABLE['rain_ratio']['threshold'])
+        | (np.asarray(flow_ratios) > SEVERITY_TABLE['flow_ratio']['threshold'])
+    )
+
+
+def score_severity(sizes, rain_ratios, flow_ratios, endangered):
+    """Scores the severity of a batch of obstacles in one vectorized pass.
+
+    Args:
+        sizes (array-like): Sizes of the obstacles
+        rain_ratios (array-like): Ratios of precipitation in next week to the precipitation in the last month
+        flow_ratios (array-like): Ratios of water flow in next week to the water flow in the last month
+        endangered (array-like): True for obstacles in an endangered area
+
+    Returns:
+        np.ndarray: Severity levels 1 (low), 2 (medium) or 3 (high)
+    """
+    table = SEVERITY_TABLE
+    score = np.asarray(table['size']['scores'])[np.digitize(sizes, table['size']['bins'])]
+    score += np.where(endangered, table['endangered']['score'], 0)
+    score += np.where(np.asarray(rain_ratios) > table['rain_ratio']['threshold'], table['rain_ratio']['score'], 0)
+    score += np.where(np.asarray(flow_ratios) > table['flow_ratio']['threshold'], table['flow_ratio']['score'], 0)
+    return np.digitize(score, table['levels']['bins'], right=True) + 1
+
+
+def score_detections(detections):
+    """Scores a table of detections, e.g. a GeoDataFrame.
+
+    Args:
+        detections: Table with columns size, rain_ratio, flow_ratio and endangered
+
+    Returns:
+        np.ndarray: Severity levels, see `score_severity`
+    """
+    return score_severity(
+        detections['size'], detections['rain_ratio'],
+        detections['flow_ratio'], detections['endangered']
+    )
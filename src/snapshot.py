@@ -0,0 +1,82 @@
+import gzip
+import hashlib
+import json
+import threading
+import time
+
+
+class Snapshot:
+    """Precomputed JSON response that a background thread refreshes periodically.
+    The encoded body, its gzip compressed version and ETag are kept in memory
+    so requests are answered without recomputing anything.
+
+    Args:
+        build (callable): Returns the JSON serializable data of the snapshot
+        interval (float): Seconds between refreshes
+    """
+
+    def __init__(self, build, interval=600):
+        self.build = build
+        self.interval = interval
+        self.lock = threading.Lock()
+        # serializes builds, the current snapshot stays readable under `lock` meanwhile
+        self.build_lock = threading.RLock()
+        self.current = None
+        self.thread = None
+
+    def refresh(self):
+        """Rebuilds the snapshot, the previous one is served until this finishes."""
+        with self.build_lock:
+            self._refresh()
+
+    def _refresh(self):
+        start = time.perf_counter()
+        body = json.dumps(self.build()).encode()
+        current = {
+            'body': body,
+            'gzip': gzip.compress(body),
+            'etag': hashlib.sha1(body).hexdigest(),
+            'updated': time.time(),
+            'build_ms': (time.perf_counter() - start) * 1000,
+        }
+        with self.lock:
+            self.current = current
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                # keep serving the last good snapshot
+                print(f'Snapshot refresh failed: {e}')
+
+    def start(self):
+        """Starts the background refresh, calling it again has no effect."""
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def get(self):
+        """Returns the current snapshot, building the first one if needed.
+
+        Returns:
+            dict: Snapshot with keys body, gzip, etag, updated and build_ms
+        """
+        with self.lock:
+            current = self.current
+        if current is None:
+            # concurrent first requests wait for one build instead of each building
+            with self.build_lock:
+                with self.lock:
+                    current = self.current
+                if current is None:
+                    try:
+                        self._refresh()
+                    finally:
+                        # retried in the background even if the first build fails
+                        self.start()
+                    with self.lock:
+                        current = self.current
+        return current
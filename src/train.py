@@ -15,6 +15,26 @@ if __name__ == "__main__":
     parser.add_argument(
         "--mask_root", type=Path, help="Path to dir containing masks."
     )
+    parser.add_argument(
+        "--cache_root", type=Path, default=None,
+        help="Path to tile cache written by preprocess.py, used instead of the images."
+    )
+    parser.add_argument(
+        "--tile_batch_size", type=int, default=None,
+        help="Train on batches of single river tiles from the tile cache."
+    )
+    parser.add_argument(
+        "--num_workers", type=int, default=4,
+        help="Data loader workers."
+    )
+    parser.add_argument(
+        "--cls_head", action="store_true",
+        help="Jointly train a tile classifier used to gate the decoder at inference."
+    )
+    parser.add_argument(
+        "--cls_loss_weight", type=float, default=1.0,
+        help="Weight of the tile classifier loss."
+    )
     parser.add_argument(
         "--seed", type=int, default=1337,
         help="RNG seed."
@@ -22,9 +42,10 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     L.seed_everything(args.seed)
-    model = RiverDebrisModel(lr=1e-4)
+    model = RiverDebrisModel(lr=1e-4, cls_head=args.cls_head, cls_loss_weight=args.cls_loss_weight)
     datamodule = RiverDebrisDataModule(
-        args.img_root, args.mask_root, (2048, 2048), (256, 256)
+        args.img_root, args.mask_root, (2048, 2048), (256, 256), args.cache_root,
+        args.tile_batch_size, args.num_workers
     )
     trainer = L.Trainer(
         logger=WandbLogger(f"SegCls", project="Dragonhack"),
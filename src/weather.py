@@ -0,0 +1,133 @@
+import threading
+import time
+
+import numpy as np
+import openmeteo_requests
+import requests_cache
+from retry_requests import retry
+
+FLOW_URL = "https://flood-api.open-meteo.com/v1/flood"
+RAIN_URL = "https://api.open-meteo.com/v1/forecast"
+
+
+class OpenMeteoClient:
+    """Fetches river discharge and precipitation ratios from the Open-Meteo API.
+
+    Args:
+        expire_after (int): Seconds the HTTP responses are kept in the requests cache
+    """
+
+    def __init__(self, expire_after=3600):
+        # Setup the Open-Meteo API client with cache and retry on error
+        cache_session = requests_cache.CachedSession('.cache', expire_after=expire_after)
+        retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
+        self.openmeteo = openmeteo_requests.Client(session=retry_session)
+
+    def fetch(self, latitudes: list, longitudes: list):
+        """Fetches the weather data for all coordinates in one request per API.
+
+        Args:
+            latitudes (list): List of latitudes (floats) to get the weather data for
+            longitudes (list): List of longitudes (floats) to get the weather data for
+        Returns:
+            list: List of weather data values:
+                - lat (float): Latitude of the measurement
+                - lon (float): Longitude of the measurement
+                - rain_ratio (float): Ratio of precipitation in next week to the precipitation in the last month
+                - flow_ratio (float): Ratio of water flow in next week to the water flow in the last month
+        """
+        flow_params = {
+            "latitude": latitudes,
+            "longitude": longitudes,
+            "daily": "river_discharge",
+            "past_days": 31,
+            "forecast_days": 7
+        }
+        rain_params = {
+            "latitude": latitudes,
+            "longitude": longitudes,
+            "daily": "precipitation_sum",
+            "past_days": 31,
+            "forecast_days": 7
+        }
+
+        flow_responses = self.openmeteo.weather_api(FLOW_URL, params=flow_params)
+        rain_responses = self.openmeteo.weather_api(RAIN_URL, params=rain_params)
+        results = []
+
+        for flow_response, rain_response in zip(flow_responses, rain_responses):
+            lat = rain_response.Latitude()
+            lon = rain_response.Longitude()
+            print(f"Coordinates {lat}°N {lon}°E")
+
+            flow_daily = flow_response.Daily()
+            daily_river_discharge = flow_daily.Variables(0).ValuesAsNumpy()
+            mean_flow_last_month = daily_river_discharge[:-7].mean()
+            mean_flow_next_week = daily_river_discharge[-7:].mean()
+            flow_ratio = np.round(mean_flow_next_week / mean_flow_last_month, 2)
+
+            rain_daily = rain_response.Daily()
+            daily_precipitation_sum = rain_daily.Variables(0).ValuesAsNumpy()
+            mean_rain_last_month = daily_precipitation_sum[:-7].mean()
+            mean_rain_next_week = daily_precipitation_sum[-7:].mean()
+            rain_ratio = np.round(mean_rain_next_week / mean_rain_last_month, 2)
+
+            results.append({
+                'lat': lat,
+                'lon': lon,
+                'rain_ratio': rain_ratio,
+                'flow_ratio': flow_ratio
+            })
+        return results
+
+
+class WeatherCache:
+    """In-process weather cache keyed on a snapped lat/lon grid cell.
+    Points that fall into the same cell share one lookup and all missing cells
+    of a query are fetched with a single batched request.
+
+    Args:
+        client: Object with a `fetch(latitudes, longitudes)` method, see `OpenMeteoClient`.
+            Defaults to the Open-Meteo API, can be replaced by a local stub.
+        ttl (float): Seconds a cached cell is valid for
+        cell_size (float): Size of the grid cells in degrees
+    """
+
+    def __init__(self, client=None, ttl=3600, cell_size=0.05):
+        self.client = client if client is not None else OpenMeteoClient(expire_after=ttl)
+        self.ttl = ttl
+        self.cell_size = cell_size
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def cell(self, lat, lon):
+        """Returns the grid cell key of a coordinate."""
+        return round(lat / self.cell_size), round(lon / self.cell_size)
+
+    def expired(self, keys):
+        """Returns the keys that are not cached or whose entry has expired."""
+        now = time.monotonic()
+        with self.lock:
+            return [key for key in keys if key not in self.entries or self.entries[key][0] <= now]
+
+    def get(self, latitudes: list, longitudes: list):
+        """Returns the weather data for every coordinate, see `OpenMeteoClient.fetch`."""
+        keys = [self.cell(lat, lon) for lat, lon in zip(latitudes, longitudes)]
+        missing = list(dict.fromkeys(self.expired(keys)))
+
+        if missing:
+            # query the cell centers so all points of a cell get the same data
+            results = self.client.fetch(
+                [key[0] * self.cell_size for key in missing],
+                [key[1] * self.cell_size for key in missing]
+            )
+            expires = time.monotonic() + self.ttl
+            with self.lock:
+                self.entries.update((key, (expires, result)) for key, result in zip(missing, results))
+
+        with self.lock:
+            results = {key: self.entries[key][1] for key in set(keys)}
+            # evict expired entries
+            now = time.monotonic()
+            self.entries = {key: entry for key, entry in self.entries.items() if entry[0] > now}
+        return [results[key] for key in keys]
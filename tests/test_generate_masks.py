@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+gpd = pytest.importorskip("geopandas")
+pytest.importorskip("pyarrow")
+pytest.importorskip("rasterio")
+from shapely.geometry import LineString
+
+import generate_masks
+from generate_masks import RiverIndex
+
+
+def write_shapefile(seg_dir, x):
+    rivers = gpd.GeoDataFrame(geometry=[LineString([(x, 0), (x, 100)])], crs="EPSG:3794")
+    rivers.to_file(seg_dir / "rivers.shp")
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    """Counts the slow segmentation reads, the real one drops the columns of the source layer."""
+    calls = []
+
+    def read_segmentation(seg_path):
+        calls.append(seg_path)
+        return gpd.read_file(seg_path)
+
+    monkeypatch.setattr(generate_masks, "read_segmentation", read_segmentation)
+    return calls
+
+
+def test_cache_is_reused_while_the_directory_is_unchanged(tmp_path, reads):
+    seg_dir, cache_path = tmp_path / "water_seg", tmp_path / "water_seg.parquet"
+    seg_dir.mkdir()
+    write_shapefile(seg_dir, 10)
+
+    RiverIndex.load(seg_dir, cache_path)
+    index = RiverIndex.load(seg_dir, cache_path)
+    assert len(reads) == 1
+    assert index.geometries[0].bounds[0] == 10
+
+
+def test_cache_is_rebuilt_when_a_file_in_the_directory_changes(tmp_path, reads):
+    seg_dir, cache_path = tmp_path / "water_seg", tmp_path / "water_seg.parquet"
+    seg_dir.mkdir()
+    write_shapefile(seg_dir, 10)
+    RiverIndex.load(seg_dir, cache_path)
+
+    # rewrite the shapefile in place, the directory mtime stays older than the cache
+    write_shapefile(seg_dir, 20)
+    cache_mtime = cache_path.stat().st_mtime
+    os.utime(seg_dir, (cache_mtime - 10, cache_mtime - 10))
+    for path in seg_dir.iterdir():
+        os.utime(path, (cache_mtime + 10, cache_mtime + 10))
+
+    index = RiverIndex.load(seg_dir, cache_path)
+    assert len(reads) == 2
+    assert index.geometries[0].bounds[0] == 20
@@ -0,0 +1,153 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+discord = pytest.importorskip("discord")
+
+from notifier import MAX_MESSAGE_LENGTH, AlertDispatcher, TokenBucket
+
+
+class FakeChannel:
+    """Local stand-in for a discord Messageable, records what is sent."""
+
+    def __init__(self, name="alerts", fail=False):
+        self.name = name
+        self.fail = fail
+        self.sent = []
+
+    async def send(self, content):
+        if self.fail:
+            raise discord.HTTPException(SimpleNamespace(status=500, reason="Internal Server Error"), "send failed")
+        self.sent.append(content)
+        return content
+
+
+def alert(severity="medium", lat=46.05, lon=14.5):
+    return {
+        "location": (lat, lon),
+        "precipitation_ratio": 1.7,
+        "water_flow_ratio": 1.3,
+        "severity": severity,
+    }
+
+
+def test_alerts_within_window_are_coalesced():
+    channel = FakeChannel()
+    dispatcher = AlertDispatcher(window=0.05, rate=5, per=1.0)
+
+    async def main():
+        task = asyncio.create_task(dispatcher.run())
+        for i in range(10):
+            dispatcher.submit(channel, alert(lat=46 + i / 100))
+        await asyncio.sleep(0.2)
+        task.cancel()
+
+    asyncio.run(main())
+    assert len(channel.sent) == 1
+    assert channel.sent[0].startswith("10 obstacles detected:")
+    assert channel.sent[0].count("\n- (") == 10
+
+
+def test_high_severity_digest_first_with_everyone():
+    channel = FakeChannel()
+    dispatcher = AlertDispatcher(window=0.0)
+    dispatcher.submit(channel, alert("medium"))
+    dispatcher.submit(channel, alert("high"))
+    dispatcher.submit(channel, alert("medium"))
+
+    asyncio.run(dispatcher.flush())
+    assert len(channel.sent) == 2
+    assert channel.sent[0].startswith("@everyone")
+    assert "1 high severity obstacles" in channel.sent[0]
+    assert "@everyone" not in channel.sent[1]
+    assert channel.sent[1].startswith("2 obstacles detected:")
+
+
+def test_high_severity_first_across_channels():
+    order = []
+
+    class OrderedChannel(FakeChannel):
+        async def send(self, content):
+            order.append((self.name, content.startswith("@everyone")))
+
+    a, b = OrderedChannel("a"), OrderedChannel("b")
+    dispatcher = AlertDispatcher(window=0.0)
+    dispatcher.submit(a, alert("medium"))
+    dispatcher.submit(b, alert("high"))
+
+    asyncio.run(dispatcher.flush())
+    assert order == [("b", True), ("a", False)]
+
+
+def test_digest_split_at_message_limit():
+    channel = FakeChannel()
+    dispatcher = AlertDispatcher(window=0.0, rate=100, per=1.0)
+    for i in range(200):
+        dispatcher.submit(channel, alert(lat=46 + i / 1000))
+
+    asyncio.run(dispatcher.flush())
+    assert len(channel.sent) > 1
+    assert all(len(message) <= MAX_MESSAGE_LENGTH for message in channel.sent)
+    assert sum(message.count("\n- (") for message in channel.sent) == 200
+    assert all(message.startswith("200 obstacles detected:") for message in channel.sent)
+
+
+def test_token_bucket_waits_when_empty():
+    async def main():
+        bucket = TokenBucket(rate=2, per=0.2)
+        return [await bucket.acquire() for _ in range(3)]
+
+    waits = asyncio.run(main())
+    assert waits[:2] == [0.0, 0.0]
+    assert waits[2] > 0
+
+
+def test_rate_limit_is_counted():
+    channel = FakeChannel()
+    dispatcher = AlertDispatcher(window=0.0, rate=1, per=0.1)
+    # a digest split into several messages through a bucket of 1 message per 0.1s
+    for i in range(100):
+        dispatcher.submit(channel, alert(lat=46 + i / 1000))
+
+    asyncio.run(dispatcher.flush())
+    assert len(channel.sent) >= 2
+    assert dispatcher.stats()["rate_limited"] == len(channel.sent) - 1
+
+
+def test_sent_and_failed_counters():
+    ok, broken = FakeChannel("ok"), FakeChannel("broken", fail=True)
+    dispatcher = AlertDispatcher(window=0.0)
+    dispatcher.submit(ok, alert("high"))
+    dispatcher.submit(ok, alert("medium"))
+    dispatcher.submit(broken, alert("medium"))
+
+    asyncio.run(dispatcher.flush())
+    stats = dispatcher.stats()
+    assert stats["sent"] == 2
+    assert stats["failed"] == 1
+    assert stats["queued"] == 0
+    assert stats["messages"] == 2
+    assert stats["mean_latency_s"] >= 0
+
+
+def test_run_survives_unexpected_send_errors():
+    class BrokenChannel(FakeChannel):
+        async def send(self, content):
+            raise RuntimeError("connection reset")
+
+    ok, broken = FakeChannel("ok"), BrokenChannel("broken")
+    dispatcher = AlertDispatcher(window=0.01)
+
+    async def main():
+        task = asyncio.create_task(dispatcher.run())
+        dispatcher.submit(broken, alert())
+        await asyncio.sleep(0.05)
+        dispatcher.submit(ok, alert())
+        await asyncio.sleep(0.05)
+        assert not task.done()
+        task.cancel()
+
+    asyncio.run(main())
+    assert dispatcher.stats()["failed"] == 1
+    assert len(ok.sent) == 1
@@ -0,0 +1,56 @@
+import threading
+import time
+
+import pytest
+
+from snapshot import Snapshot
+
+
+def test_concurrent_first_requests_build_once():
+    builds = []
+
+    def build():
+        builds.append(1)
+        time.sleep(0.1)
+        return {"value": len(builds)}
+
+    snapshot = Snapshot(build, interval=3600)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(snapshot.get())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(builds) == 1
+    assert all(result is results[0] for result in results)
+    assert snapshot.thread is not None
+
+
+def test_background_refresh_starts_when_the_first_build_fails():
+    calls = []
+
+    def build():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("upstream down")
+        return {"ok": True}
+
+    snapshot = Snapshot(build, interval=0.05)
+    with pytest.raises(RuntimeError):
+        snapshot.get()
+    assert snapshot.thread is not None
+
+    # the background thread recovers without another request
+    deadline = time.monotonic() + 2
+    while snapshot.current is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert snapshot.get()["body"] == b'{"ok": true}'
+
+
+def test_start_is_idempotent():
+    snapshot = Snapshot(lambda: {}, interval=3600)
+    snapshot.start()
+    thread = snapshot.thread
+    snapshot.start()
+    assert snapshot.thread is thread
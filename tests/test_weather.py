@@ -0,0 +1,66 @@
+import time
+
+import pytest
+
+pytest.importorskip("openmeteo_requests")
+pytest.importorskip("requests_cache")
+pytest.importorskip("retry_requests")
+
+from weather import WeatherCache
+
+
+class StubClient:
+    """Local stand-in for `OpenMeteoClient`, records every fetch."""
+
+    def __init__(self):
+        self.calls = []
+
+    def fetch(self, latitudes, longitudes):
+        self.calls.append((list(latitudes), list(longitudes)))
+        return [
+            {"lat": lat, "lon": lon, "rain_ratio": 1.0, "flow_ratio": 1.0}
+            for lat, lon in zip(latitudes, longitudes)
+        ]
+
+
+def test_points_in_shared_cells_cost_one_fetch():
+    client = StubClient()
+    cache = WeatherCache(client, ttl=3600, cell_size=0.05)
+    # 10 points in 2 cells
+    lats = [46.051 + i * 0.001 for i in range(5)] + [46.201 + i * 0.001 for i in range(5)]
+    lons = [14.501] * 10
+
+    results = cache.get(lats, lons)
+    assert len(client.calls) == 1
+    assert len(client.calls[0][0]) == 2
+    assert len(results) == 10
+    # points of a cell share the same data
+    assert results[0] is results[4]
+    assert results[5] is results[9]
+
+    # a second query of cached cells does not fetch
+    cache.get(lats[:3], lons[:3])
+    assert len(client.calls) == 1
+
+
+def test_only_missing_cells_are_fetched():
+    client = StubClient()
+    cache = WeatherCache(client, ttl=3600, cell_size=0.05)
+    cache.get([46.05], [14.5])
+    cache.get([46.05, 46.5], [14.5, 14.5])
+    assert len(client.calls) == 2
+    assert len(client.calls[1][0]) == 1
+    assert abs(client.calls[1][0][0] - 46.5) < 1e-9
+
+
+def test_expired_entries_are_refetched():
+    client = StubClient()
+    cache = WeatherCache(client, ttl=0.1, cell_size=0.05)
+    cache.get([46.05, 46.06], [14.5, 14.5])
+    cache.get([46.05], [14.5])
+    assert len(client.calls) == 1
+
+    time.sleep(0.15)
+    cache.get([46.05], [14.5])
+    assert len(client.calls) == 2
+    assert cache.expired([cache.cell(46.05, 14.5)]) == []